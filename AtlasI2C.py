@@ -1,11 +1,154 @@
 #!/usr/bin/python
 
-import io
 import sys
 import fcntl
 import time
 import copy
+import json
+import logging
+import os
 import string
+import threading
+
+import metrics
+from atomic_file import write_atomic
+
+
+# clears the most significant bit of every byte, see AtlasI2C.handle_raspi_glitch
+MSB_MASK_TABLE = bytes(i & 0x7F for i in range(256))
+
+
+def parse_values(text):
+    '''
+    returns the numeric fields of a response as floats, works on str and bytes
+    '''
+    values = []
+    for field in text.split("," if isinstance(text, str) else b","):
+        try:
+            values.append(float(field))
+        except ValueError:
+            pass
+    return tuple(values)
+
+
+class Reading:
+    __slots__ = ("address", "device_info", "command", "status", "text", "values", "timestamp", "error")
+
+    def __init__(self, address, device_info, command, status=None, text="", timestamp=None, error=None,
+                 values=None):
+        self.address = address
+        self.device_info = device_info
+        self.command = command
+        # 1 is success, the other codes come straight from the board (254 still processing, 255 no data, 2 failed)
+        self.status = status
+        self.text = text
+        self.values = values if values is not None else parse_values(text)
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and self.status in (None, 1)
+
+    @property
+    def value(self):
+        return self.values[0] if self.values else None
+
+    def __str__(self):
+        if self.error is not None:
+            return "Error " + self.device_info + ": " + str(self.error)
+        if self.ok:
+            return "Success " + self.device_info + ": " + self.text
+        return "Error " + self.device_info + ": " + str(self.status)
+
+
+def parse_response(buffer, length, address, device_info, command=""):
+    '''
+    parses a raw response sitting in buffer[:length] straight into a Reading.
+    the first byte is the status code, the text runs up to the first null and
+    has its MSB cleared with a lookup table instead of per character
+    '''
+    if length == 0:
+        return Reading(address, device_info, command, values=())
+
+    status = buffer[0]
+    if status != 1:
+        return Reading(address, device_info, command, status, values=())
+
+    end = buffer.find(0, 1, length)
+    if end < 0:
+        end = length
+    raw = buffer[1:end].translate(MSB_MASK_TABLE)
+    return Reading(address, device_info, command, status, raw.decode("latin-1"), values=parse_values(raw))
+
+
+class I2CBus:
+    '''
+    one read/write file descriptor per I2C bus, shared by every AtlasI2C
+    object on that bus. the slave address is switched with an ioctl right
+    before a transfer, and only when it changed
+    '''
+    I2C_SLAVE = 0x703
+    _buses = {}
+    _buses_lock = threading.Lock()
+    # bus number -> object standing in for /dev/i2c-N with the same set_address/write/readinto/release
+    # methods, used instead of the real bus, see atlas_emulator.EmulatedI2CBus
+    _backends = {}
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.fd = os.open("/dev/i2c-{}".format(bus), os.O_RDWR)
+        self.lock = threading.RLock()
+        self._address = None
+        self._users = 0
+
+    @classmethod
+    def register_backend(cls, bus, backend):
+        with cls._buses_lock:
+            cls._backends[bus] = backend
+
+    @classmethod
+    def unregister_backend(cls, bus):
+        with cls._buses_lock:
+            cls._backends.pop(bus, None)
+
+    @classmethod
+    def acquire(cls, bus):
+        with cls._buses_lock:
+            backend = cls._backends.get(bus)
+            if backend is not None:
+                return backend
+            i2c_bus = cls._buses.get(bus)
+            if i2c_bus is None:
+                i2c_bus = cls._buses[bus] = cls(bus)
+            i2c_bus._users += 1
+            return i2c_bus
+
+    def release(self):
+        with self._buses_lock:
+            self._users -= 1
+            if self._users == 0:
+                del self._buses[self.bus]
+                self.close()
+
+    def close(self):
+        os.close(self.fd)
+
+    def set_address(self, addr):
+        with self.lock:
+            if addr != self._address:
+                fcntl.ioctl(self.fd, self.I2C_SLAVE, addr)
+                self._address = addr
+
+    def write(self, addr, data):
+        with self.lock:
+            self.set_address(addr)
+            os.write(self.fd, data)
+
+    def readinto(self, addr, buffer):
+        with self.lock:
+            self.set_address(addr)
+            return os.readv(self.fd, [buffer])
 
 
 class AtlasI2C:
@@ -21,24 +164,24 @@ class AtlasI2C:
     DEFAULT_ADDRESS = 98
     LONG_TIMEOUT_COMMANDS = ("R", "CAL")
     SLEEP_COMMANDS = ("SLEEP", )
+    # 7-bit addresses outside this range are reserved by the I2C spec, no board can sit there
+    FIRST_ADDRESS = 0x08
+    LAST_ADDRESS = 0x77
 
     def __init__(self, address=None, moduletype = "", name = "", bus=None):
         '''
-        open two file streams, one for reading and one for writing
+        share the file descriptor of the I2C channel with every other device on it
         the specific I2C channel is selected with bus
         it is usually 1, except for older revisions where its 0
-        wb and rb indicate binary read and write
+        responses are read into a buffer that is reused for every read
         '''
         self._address = address or self.DEFAULT_ADDRESS
         self.bus = bus or self.DEFAULT_BUS
         self._long_timeout = self.LONG_TIMEOUT
         self._short_timeout = self.SHORT_TIMEOUT
-        self.file_read = io.open(file="/dev/i2c-{}".format(self.bus), 
-                                 mode="rb", 
-                                 buffering=0)
-        self.file_write = io.open(file="/dev/i2c-{}".format(self.bus),
-                                  mode="wb", 
-                                  buffering=0)
+        self._buffer = bytearray(31)
+        self._view = memoryview(self._buffer)
+        self._bus = I2CBus.acquire(self.bus)
         self.set_i2c_address(self._address)
         self._name = name
         self._module = moduletype
@@ -71,9 +214,7 @@ class AtlasI2C:
         the commands for I2C dev using the ioctl functions are specified in
         the i2c-dev.h file from i2c-tools
         '''
-        I2C_SLAVE = 0x703
-        fcntl.ioctl(self.file_read, I2C_SLAVE, addr)
-        fcntl.ioctl(self.file_write, I2C_SLAVE, addr)
+        self._bus.set_address(addr)
         self._address = addr
 
     def write(self, cmd):
@@ -81,7 +222,7 @@ class AtlasI2C:
         appends the null character and sends the string over I2C
         '''
         cmd += "\00"
-        self.file_write.write(cmd.encode('latin-1'))
+        self._bus.write(self._address, cmd.encode('latin-1'))
 
     def handle_raspi_glitch(self, response):
         '''
@@ -127,19 +268,30 @@ class AtlasI2C:
         else:
             return self._module + " " + str(self.address) + " " + self._name
         
+    def read_response(self, num_of_bytes=31):
+        '''
+        reads a specified number of bytes from I2C and returns the status code
+        and the response text, the text is None if the board reported an error
+        '''
+        reading = self.read_reading(num_of_bytes=num_of_bytes)
+        error_code = str(reading.status) if reading.status is not None else None
+        return error_code, (reading.text if reading.ok else None)
+
+    def read_reading(self, command="", num_of_bytes=31):
+        '''
+        reads the response of the last command into a Reading
+        '''
+        length = self._bus.readinto(self._address, self._view[:num_of_bytes])
+        return parse_response(self._buffer, length, self._address, self.get_device_info(), command)
+
     def read(self, num_of_bytes=31):
         '''
         reads a specified number of bytes from I2C, then parses and displays the result
         '''
-        
-        raw_data = self.file_read.read(num_of_bytes)
-        response = self.get_response(raw_data=raw_data)
-        #print(response)
-        is_valid, error_code = self.response_valid(response=response)
-
-        if is_valid:
-            char_list = self.handle_raspi_glitch(response[1:])
-            result = "Success " + self.get_device_info() + ": " +  str(''.join(char_list))
+        error_code, text = self.read_response(num_of_bytes)
+
+        if text is not None:
+            result = "Success " + self.get_device_info() + ": " +  text
             #result = "Success: " +  str(''.join(char_list))
         else:
             result = "Error " + self.get_device_info() + ": " + error_code
@@ -160,32 +312,134 @@ class AtlasI2C:
         write a command to the board, wait the correct timeout, 
         and read the response
         '''
-        self.write(command)
-        current_timeout = self.get_command_timeout(command=command)
-        if not current_timeout:
-            return "sleep mode"
-        else:
-            time.sleep(current_timeout)
-            return self.read()
+        with metrics.timer("atlas_query_seconds", command=command.split(",")[0].upper()):
+            self.write(command)
+            current_timeout = self.get_command_timeout(command=command)
+            if not current_timeout:
+                return "sleep mode"
+            else:
+                time.sleep(current_timeout)
+                return self.read()
 
     def close(self):
-        self.file_read.close()
-        self.file_write.close()
+        if self._bus is not None:
+            self._bus.release()
+            self._bus = None
 
-    def list_i2c_devices(self):
+    def probe(self, addr):
+        '''
+        returns True if a device acknowledges a one byte read at addr,
+        leaves the address switched to addr
+        '''
+        try:
+            self.set_i2c_address(addr)
+            self._bus.readinto(addr, self._view[:1])
+            return True
+        except IOError:
+            return False
+
+    def list_i2c_devices(self, addresses=None):
         '''
         save the current address so we can restore it after
         '''
         prev_addr = copy.deepcopy(self._address)
-        i2c_devices = []
-        for i in range(0, 128):
-            try:
-                self.set_i2c_address(i)
-                self.read(1)
-                i2c_devices.append(i)
-            except IOError:
-                pass
+        if addresses is None:
+            addresses = range(self.FIRST_ADDRESS, self.LAST_ADDRESS + 1)
+        i2c_devices = [i for i in addresses if self.probe(i)]
         # restore the address we were using
         self.set_i2c_address(prev_addr)
 
         return i2c_devices
+
+
+def query_devices(devices, command="R"):
+    '''
+    writes the command to every device at once, then reads each device as
+    soon as its own timeout has passed, so reading N sensors takes about
+    one long timeout instead of N of them. returns one Reading per device,
+    in the same order as devices
+    '''
+    with metrics.timer("atlas_query_devices_seconds", command=command.split(",")[0].upper()):
+        readings = _query_devices(devices, command)
+    metrics.count("atlas_readings_failed_total", sum(not reading.ok for reading in readings))
+    return readings
+
+
+def _query_devices(devices, command):
+    readings = [None] * len(devices)
+    pending = []
+    for i, device in enumerate(devices):
+        try:
+            device.write(command)
+        except IOError as e:
+            readings[i] = Reading(device.address, device.get_device_info(), command, error=e)
+            continue
+
+        timeout = device.get_command_timeout(command)
+        if timeout is None:
+            # sleep commands have no response to read
+            readings[i] = Reading(device.address, device.get_device_info(), command, text="sleep mode")
+        else:
+            pending.append((time.time() + timeout, i, device))
+
+    for deadline, i, device in sorted(pending, key=lambda p: p[0]):
+        remaining = deadline - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        try:
+            readings[i] = device.read_reading(command)
+        except IOError as e:
+            readings[i] = Reading(device.address, device.get_device_info(), command, error=e)
+
+    return readings
+
+
+DEVICE_CACHE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "i2c_devices.json")
+
+
+def _response_field(reading, index=1):
+    # info responses look like "?I,pH,1.98" or "?NAME,tank"
+    fields = reading.text.split(",")
+    if not reading.ok or len(fields) <= index:
+        return ""
+    return fields[index]
+
+
+def discover_devices(bus=None, cache_file=DEVICE_CACHE_FILE):
+    '''
+    returns an AtlasI2C object for every board on the bus. a warm start only
+    checks that the cached addresses still answer, the full address scan and
+    the info queries only run when the cache is missing or out of date.
+    delete the cache file after adding a board so it gets picked up
+    '''
+    scanner = AtlasI2C(bus=bus)
+    try:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = None
+
+        if cached and len(scanner.list_i2c_devices([d["address"] for d in cached])) == len(cached):
+            return [
+                AtlasI2C(address=d["address"], moduletype=d["moduletype"], name=d["name"], bus=bus)
+                for d in cached
+            ]
+
+        devices = [AtlasI2C(address=addr, bus=bus) for addr in scanner.list_i2c_devices()]
+    finally:
+        scanner.close()
+
+    # one broadcast per info command for all boards instead of two queries per board
+    for device, reading in zip(devices, query_devices(devices, "I")):
+        device._module = _response_field(reading)
+    for device, reading in zip(devices, query_devices(devices, "name,?")):
+        device._name = _response_field(reading)
+
+    try:
+        devices_json = [{"address": d.address, "moduletype": d.moduletype, "name": d.name} for d in devices]
+        write_atomic(cache_file, json.dumps(devices_json))
+    except OSError as err:
+        logging.error(f"Could not save the I2C device cache - {err}")
+
+    return devices
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from AtlasI2C import Reading
+
+
+class AsyncAtlasI2C:
+    '''
+    asyncio front end for an AtlasI2C device. command timeouts are awaited
+    instead of slept, and the bus transfers run in the default executor
+    behind one lock per bus, so a single event loop can poll sensors next to
+    capture scheduling and network I/O
+    '''
+    # event loop -> {bus number: lock}, an asyncio.Lock belongs to the loop it was first used in, so every loop
+    # gets its own. the locks hold on to their loop, the ones of closed loops are dropped when a new loop shows up
+    _bus_locks = {}
+
+    def __init__(self, device):
+        self.device = device
+
+    @property
+    def address(self):
+        return self.device.address
+
+    def get_device_info(self):
+        return self.device.get_device_info()
+
+    def _bus_lock(self):
+        loop = asyncio.get_running_loop()
+        locks = self._bus_locks.get(loop)
+        if locks is None:
+            for closed in [other for other in self._bus_locks if other.is_closed()]:
+                del self._bus_locks[closed]
+            locks = self._bus_locks[loop] = {}
+        lock = locks.get(self.device.bus)
+        if lock is None:
+            lock = locks[self.device.bus] = asyncio.Lock()
+        return lock
+
+    async def _transfer(self, func, *args):
+        async with self._bus_lock():
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def write(self, cmd):
+        await self._transfer(self.device.write, cmd)
+
+    async def read(self, num_of_bytes=31):
+        return await self._transfer(self.device.read, num_of_bytes)
+
+    async def read_reading(self, command=""):
+        return await self._transfer(self.device.read_reading, command)
+
+    async def query(self, command):
+        '''
+        write a command to the board, wait the correct timeout,
+        and read the response
+        '''
+        await self.write(command)
+        current_timeout = self.device.get_command_timeout(command=command)
+        if not current_timeout:
+            return "sleep mode"
+        await asyncio.sleep(current_timeout)
+        return await self.read()
+
+    async def query_reading(self, command="R"):
+        '''
+        same as query but returns a Reading, bus errors end up in Reading.error
+        '''
+        try:
+            await self.write(command)
+            current_timeout = self.device.get_command_timeout(command=command)
+            if not current_timeout:
+                return Reading(self.address, self.get_device_info(), command, text="sleep mode")
+            await asyncio.sleep(current_timeout)
+            return await self.read_reading(command)
+        except IOError as e:
+            return Reading(self.address, self.get_device_info(), command, error=e)
+
+
+async def query_devices(devices, command="R"):
+    '''
+    sends the command to every device and waits for all the responses, the
+    timeouts overlap so the whole round takes about one long timeout
+    '''
+    return await asyncio.gather(*(device.query_reading(command) for device in devices))
+
+
+async def poll_devices(devices, interval, on_readings, command="R"):
+    '''
+    polls every device each interval seconds and hands the readings to
+    on_readings, runs until cancelled
+    '''
+    next_poll = time.monotonic()
+    while True:
+        on_readings(await query_devices(devices, command))
+        next_poll += interval
+        await asyncio.sleep(max(0, next_poll - time.monotonic()))
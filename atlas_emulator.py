@@ -0,0 +1,167 @@
+import errno
+import random
+import threading
+import time
+
+from AtlasI2C import AtlasI2C, I2CBus
+
+
+# response codes of the EZO boards, the first byte of every read
+SUCCESS = 1
+SYNTAX_ERROR = 2
+STILL_PROCESSING = 254
+NO_DATA = 255
+
+# module type -> (firmware, seconds a reading takes, default reading), processing times from the EZO datasheets
+MODULES = {
+    "pH": ("2.16", 0.9, lambda rng: f"{rng.gauss(7.0, 0.02):.3f}"),
+    "ORP": ("2.10", 0.9, lambda rng: f"{rng.gauss(210.0, 1.0):.1f}"),
+    "EC": ("2.14", 0.6, lambda rng: f"{rng.gauss(1413, 5):.0f}"),
+    "DO": ("2.11", 0.6, lambda rng: f"{rng.gauss(8.1, 0.05):.2f}"),
+    "RTD": ("2.13", 0.6, lambda rng: f"{rng.gauss(25.0, 0.1):.3f}"),
+}
+# every command other than R and CAL takes this long
+COMMAND_DELAY = 0.3
+
+
+class EmulatedEZO:
+    '''
+    in-process stand-in for one Atlas EZO board in I2C mode. a command is
+    only answered once its processing delay has passed, reads before that
+    get 254, reads with nothing to send get 255 and unknown commands get 2.
+    glitch_rate sets the MSB on that share of the response characters, like
+    the Raspberry Pi clock stretching glitch does
+    '''
+    def __init__(self, address, moduletype="pH", name="", reading=None, glitch_rate=0.0, speedup=1, seed=None):
+        self.address = address
+        self.moduletype = moduletype
+        self.name = name
+        self.firmware, self.read_delay, default_reading = MODULES[moduletype]
+        self._rng = random.Random(seed)
+        self._reading = reading or (lambda: default_reading(self._rng))
+        self.glitch_rate = glitch_rate
+        self.speedup = speedup
+        self.calibration_points = 0
+        self.sleeping = False
+
+        self._status = NO_DATA
+        self._text = ""
+        self._ready_at = 0.0
+
+        self.commands = 0
+        self.reads = 0
+
+    def _respond(self, delay, text="", status=SUCCESS):
+        self._status = status
+        self._text = text
+        self._ready_at = time.monotonic() + delay / self.speedup
+
+    def command(self, cmd):
+        self.commands += 1
+        # any transfer wakes a sleeping board up, the command itself is dropped
+        if self.sleeping:
+            self.sleeping = False
+            self._status = NO_DATA
+            return
+
+        upper = cmd.upper()
+        if upper == "R":
+            self._respond(self.read_delay, self._reading())
+        elif upper == "I":
+            self._respond(COMMAND_DELAY, f"?I,{self.moduletype},{self.firmware}")
+        elif upper == "NAME,?":
+            self._respond(COMMAND_DELAY, f"?NAME,{self.name}")
+        elif upper.startswith("NAME,"):
+            self.name = cmd[5:]
+            self._respond(COMMAND_DELAY)
+        elif upper == "CAL,?":
+            self._respond(COMMAND_DELAY, f"?CAL,{self.calibration_points}")
+        elif upper == "CAL,CLEAR":
+            self.calibration_points = 0
+            self._respond(self.read_delay)
+        elif upper.startswith("CAL,"):
+            self.calibration_points = min(self.calibration_points + 1, 3)
+            self._respond(self.read_delay)
+        elif upper == "SLEEP":
+            self.sleeping = True
+            self._status = NO_DATA
+        else:
+            self._respond(COMMAND_DELAY, status=SYNTAX_ERROR)
+
+    def response(self, num_of_bytes):
+        '''
+        the raw bytes a read of num_of_bytes gets back, padded with nulls
+        '''
+        self.reads += 1
+        if self.sleeping or self._status == NO_DATA:
+            return bytes([NO_DATA]).ljust(num_of_bytes, b"\x00")
+        if time.monotonic() < self._ready_at:
+            return bytes([STILL_PROCESSING]).ljust(num_of_bytes, b"\x00")
+
+        text = self._text.encode("latin-1")
+        if self.glitch_rate:
+            text = bytes(c | 0x80 if self._rng.random() < self.glitch_rate else c for c in text)
+        data = (bytes([self._status]) + text).ljust(num_of_bytes, b"\x00")[:num_of_bytes]
+        # the board answers once, reading again gets 255
+        self._status = NO_DATA
+        return data
+
+
+class EmulatedI2CBus:
+    '''
+    plays the part of I2CBus for a set of EmulatedEZO boards. transfers take
+    as long as they would at bitrate (9 bits per byte plus the address byte),
+    pass bitrate=None to skip the wait. addresses without a board fail the
+    same way the kernel driver does
+    '''
+    def __init__(self, devices=(), bus=AtlasI2C.DEFAULT_BUS, bitrate=100000):
+        self.bus = bus
+        self.devices = {device.address: device for device in devices}
+        self.bitrate = bitrate
+        self.lock = threading.RLock()
+        self._address = None
+        self.transfers = 0
+
+    def install(self):
+        I2CBus.register_backend(self.bus, self)
+        return self
+
+    def uninstall(self):
+        I2CBus.unregister_backend(self.bus)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def release(self):
+        # the emulated bus outlives the AtlasI2C objects using it
+        pass
+
+    def close(self):
+        pass
+
+    def _device(self, addr, num_of_bytes):
+        self.transfers += 1
+        if self.bitrate:
+            time.sleep((num_of_bytes + 1) * 9 / self.bitrate)
+        device = self.devices.get(addr)
+        if device is None:
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        return device
+
+    def set_address(self, addr):
+        self._address = addr
+
+    def write(self, addr, data):
+        with self.lock:
+            self.set_address(addr)
+            self._device(addr, len(data)).command(bytes(data).rstrip(b"\x00").decode("latin-1"))
+
+    def readinto(self, addr, buffer):
+        with self.lock:
+            self.set_address(addr)
+            data = self._device(addr, len(buffer)).response(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
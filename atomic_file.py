@@ -0,0 +1,13 @@
+import os
+
+
+def write_atomic(path, data):
+    '''
+    writes data (str or bytes) to a temporary file next to path and moves it
+    over path, so a power cut or a reader never sees a half written file,
+    only the old one or the new one
+    '''
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,149 @@
+import argparse
+import os
+import tempfile
+import time
+import timeit
+from contextlib import contextmanager
+
+from AtlasI2C import AtlasI2C, discover_devices, parse_response, query_devices
+from atlas_emulator import MODULES, EmulatedEZO, EmulatedI2CBus
+
+
+# raw 31 byte responses as they come off the bus, MSB glitch included on some characters
+SAMPLE_RESPONSES = {
+    "pH": b"\x01" + bytes([ord("7"), ord(".") | 0x80, ord("0"), ord("1")]) + bytes(26),
+    "EC": b"\x01" + b"1413,0.71,765,1.000".ljust(30, b"\x00"),
+    "info": b"\x01" + b"?I,pH,1.98".ljust(30, b"\x00"),
+    "error": b"\xfe" + bytes(30),
+}
+
+
+def legacy_read(device, raw_data):
+    # the string based parsing AtlasI2C.read used before responses were parsed into a Reading
+    response = device.get_response(raw_data=raw_data)
+    is_valid, error_code = device.response_valid(response=response)
+    if is_valid:
+        char_list = device.handle_raspi_glitch(response[1:])
+        result = "Success " + device.get_device_info() + ": " + str(''.join(char_list))
+    else:
+        result = "Error " + device.get_device_info() + ": " + error_code
+
+    # callers then had to split the string to get a number back out
+    try:
+        return float(result.split(":")[1].split(",")[0])
+    except ValueError:
+        return None
+
+
+def fast_read(device, buffer, raw_data):
+    buffer[:len(raw_data)] = raw_data
+    return parse_response(buffer, len(raw_data), device.address, device.get_device_info()).value
+
+
+def bench_parsing(number):
+    # parsing only, no bus involved, so the device is never opened
+    device = AtlasI2C.__new__(AtlasI2C)
+    device._address = 99
+    device._name = ""
+    device._module = "pH"
+    buffer = bytearray(31)
+
+    print(f"{'response':<8} {'legacy us/read':>15} {'fast us/read':>13} {'saving':>8}")
+    for name, raw_data in SAMPLE_RESPONSES.items():
+        legacy = timeit.timeit(lambda: legacy_read(device, raw_data), number=number) / number * 1e6
+        fast = timeit.timeit(lambda: fast_read(device, buffer, raw_data), number=number) / number * 1e6
+        print(f"{name:<8} {legacy:>15.2f} {fast:>13.2f} {1 - fast / legacy:>8.0%}")
+
+
+@contextmanager
+def emulated_bus(device_count, speedup, bitrate=100000):
+    # boards from 0x40 up, cycling through the module types, with the driver timeouts scaled like the boards
+    modules = list(MODULES)
+    devices = [
+        EmulatedEZO(0x40 + i, modules[i % len(modules)], name=f"tank{i}", glitch_rate=0.1, speedup=speedup, seed=i)
+        for i in range(device_count)
+    ]
+    timeouts = AtlasI2C.LONG_TIMEOUT, AtlasI2C.SHORT_TIMEOUT
+    AtlasI2C.LONG_TIMEOUT, AtlasI2C.SHORT_TIMEOUT = timeouts[0] / speedup, timeouts[1] / speedup
+    try:
+        with EmulatedI2CBus(devices, bitrate=bitrate) as bus:
+            yield bus
+    finally:
+        AtlasI2C.LONG_TIMEOUT, AtlasI2C.SHORT_TIMEOUT = timeouts
+
+
+def bench_discovery(device_counts, speedup):
+    print(f"\ndiscovery, board delays / {speedup}")
+    print(f"{'devices':>7} {'cold s':>8} {'warm s':>8} {'transfers cold':>15}")
+    for count in device_counts:
+        with emulated_bus(count, speedup) as bus, tempfile.TemporaryDirectory() as tmp:
+            cache_file = os.path.join(tmp, "i2c_devices.json")
+
+            start = time.perf_counter()
+            devices = discover_devices(cache_file=cache_file)
+            cold = time.perf_counter() - start
+            cold_transfers = bus.transfers
+            assert len(devices) == count
+
+            start = time.perf_counter()
+            discover_devices(cache_file=cache_file)
+            warm = time.perf_counter() - start
+        print(f"{count:>7} {cold:>8.3f} {warm:>8.3f} {cold_transfers:>15}")
+
+
+def bench_polling(device_counts, speedup, rounds):
+    print(f"\npolling throughput, board delays / {speedup}")
+    print(f"{'devices':>7} {'sequential reads/s':>19} {'broadcast reads/s':>18} {'failed':>7}")
+    for count in device_counts:
+        with emulated_bus(count, speedup):
+            devices = [AtlasI2C(address=0x40 + i) for i in range(count)]
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for device in devices:
+                    device.query("R")
+            sequential = rounds * count / (time.perf_counter() - start)
+
+            failed = 0
+            start = time.perf_counter()
+            for _ in range(rounds):
+                failed += sum(not reading.ok for reading in query_devices(devices, "R"))
+            broadcast = rounds * count / (time.perf_counter() - start)
+        print(f"{count:>7} {sequential:>19.1f} {broadcast:>18.1f} {failed:>7}")
+
+
+def bench_read_overhead(device_counts, number):
+    # boards answer instantly and the bus takes no time, what is left is the cost of the driver itself
+    print("\nper read overhead, no bus or board delays")
+    print(f"{'devices':>7} {'us/read':>8}")
+    for count in device_counts:
+        with emulated_bus(count, speedup=float("inf"), bitrate=None):
+            devices = [AtlasI2C(address=0x40 + i) for i in range(count)]
+            reads = max(1, number // count)
+
+            def read_all():
+                for device in devices:
+                    device.write("R")
+                    device.read_reading("R")
+
+            elapsed = timeit.timeit(read_all, number=reads)
+        print(f"{count:>7} {elapsed / (reads * count) * 1e6:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Atlas sensor read path.")
+    parser.add_argument("--number", type=int, default=100000, help="reads timed per sample response")
+    parser.add_argument("--devices", default="1,4,16", help="comma separated emulated board counts")
+    parser.add_argument("--speedup", type=float, default=10, help="divides the emulated board delays")
+    parser.add_argument("--rounds", type=int, default=5, help="polling rounds per board count")
+    args = parser.parse_args()
+    device_counts = [int(count) for count in args.devices.split(",")]
+
+    bench_parsing(args.number)
+    bench_discovery(device_counts, args.speedup)
+    bench_polling(device_counts, args.speedup, args.rounds)
+    bench_read_overhead(device_counts, args.number // 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pymysql
+import requests
+
+from cycle_log import CycleLogHandler
+from db_log import DBLog
+from gphoto import GPhoto
+from timed_reads import Resources, run_cycle
+from webcam import Webcam
+
+
+# typical jpg sizes in bytes (mean, standard deviation): the ribbon camera at full resolution and the
+# usb webcam at 1080p
+RIBBON_JPEG_SIZE = (4_000_000, 600_000)
+USB_JPEG_SIZE = (450_000, 80_000)
+
+
+def fake_jpeg(rng, size):
+    # random bytes between the jpg start and end markers, the stub never decodes them
+    length = max(1024, int(rng.gauss(*size)))
+    return b"\xff\xd8\xff\xe0" + os.urandom(length - 6) + b"\xff\xd9"
+
+
+class FakePiCamera:
+    def __init__(self, latency=1.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.resolution = None
+        self._rng = random.Random(seed)
+
+    def capture(self, output, format=None, use_video_port=False, quality=None):
+        time.sleep(self.latency)
+        if self._rng.random() < self.failure_rate:
+            raise RuntimeError("Fake ribbon camera failed to capture")
+        data = fake_jpeg(self._rng, RIBBON_JPEG_SIZE)
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                f.write(data)
+        else:
+            output.write(data)
+
+    def close(self):
+        pass
+
+
+class FakeUSBCamera:
+    def __init__(self, latency=0.2, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+
+    def capture_jpeg(self):
+        time.sleep(self.latency)
+        if self._rng.random() < self.failure_rate:
+            raise RuntimeError("Fake usb webcam failed to capture")
+        return fake_jpeg(self._rng, USB_JPEG_SIZE)
+
+    def close(self):
+        pass
+
+
+class PhotosStub(ThreadingHTTPServer):
+    '''
+    local stand-in for the google photos endpoints GPhoto uses, each request
+    waits latency seconds and fails with failure_rate. raw and resumable
+    uploads are both accepted, resumable chunks are checked against the
+    offset and granularity the real endpoint enforces
+    '''
+    daemon_threads = True
+    # bytes every resumable chunk but the last has to be a multiple of
+    CHUNK_GRANULARITY = 256 * 1024
+
+    def __init__(self, latency=0.05, failure_rate=0.0, seed=None):
+        super().__init__(("127.0.0.1", 0), PhotosStubHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.albums = {}
+        self.uploaded_bytes = 0
+        # file name -> (content type, bytes) of every upload the stub accepted
+        self.uploads = {}
+        # resumable upload session id -> what was announced at the start and how much arrived since
+        self.sessions = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def fail(self):
+        with self._lock:
+            return self._rng.random() < self.failure_rate
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="photos-stub", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class PhotosStubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.path.startswith("/v1/albums"):
+            albums = [{"id": album_id, "title": title} for title, album_id in self.server.albums.items()]
+            return self._reply(200, {"albums": albums} if albums else {})
+        self._reply(404, {"error": {"code": 404, "message": "Not found"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+        if self.server.fail():
+            return self._reply(500, {"error": {"code": 500, "message": "Stub failure"}})
+
+        if self.path.startswith("/upload-session/"):
+            return self._upload_session(self.path.rsplit("/", 1)[-1], body)
+
+        if self.path == "/v1/uploads" and self.headers.get("X-Goog-Upload-Protocol") == "resumable":
+            return self._start_session()
+
+        if self.path == "/v1/uploads":
+            self.server.uploaded_bytes += len(body)
+            self.server.uploads[self.headers.get("X-Goog-Upload-File-Name")] = (
+                self.headers.get("X-Goog-Upload-Content-Type"), len(body)
+            )
+            return self._reply(200, uuid.uuid4().hex.encode())
+
+        if self.path == "/v1/albums":
+            title = json.loads(body)["album"]["title"]
+            album_id = self.server.albums.setdefault(title, uuid.uuid4().hex)
+            return self._reply(200, {"id": album_id, "title": title})
+
+        if self.path == "/v1/mediaItems:batchCreate":
+            items = json.loads(body)["newMediaItems"]
+            results = [
+                {
+                    "uploadToken": item["simpleMediaItem"]["uploadToken"],
+                    "status": {"message": "Success"},
+                    "mediaItem": {"id": uuid.uuid4().hex},
+                }
+                for item in items
+            ]
+            return self._reply(200, {"newMediaItemResults": results})
+
+        self._reply(404, {"error": {"code": 404, "message": "Not found"}})
+
+    def _start_session(self):
+        if self.headers.get("X-Goog-Upload-Command") != "start":
+            return self._reply(400, {"error": {"code": 400, "message": "Expected a start command"}})
+        session_id = uuid.uuid4().hex
+        self.server.sessions[session_id] = {
+            "name": self.headers.get("X-Goog-Upload-File-Name"),
+            "content_type": self.headers.get("X-Goog-Upload-Content-Type"),
+            "size": int(self.headers.get("X-Goog-Upload-Raw-Size", 0)),
+            "received": 0,
+            "status": "active",
+        }
+        host, port = self.server.server_address
+        self._reply(200, b"", {
+            "X-Goog-Upload-Status": "active",
+            "X-Goog-Upload-URL": f"http://{host}:{port}/upload-session/{session_id}",
+            "X-Goog-Upload-Chunk-Granularity": str(self.server.CHUNK_GRANULARITY),
+        })
+
+    def _upload_session(self, session_id, body):
+        # "query" reports how much arrived, "upload" appends a chunk at the offset the client claims and
+        # "upload, finalize" appends the last chunk and hands out the upload token
+        session = self.server.sessions.get(session_id)
+        if session is None:
+            return self._reply(404, {"error": {"code": 404, "message": "No such upload session"}})
+
+        command = self.headers.get("X-Goog-Upload-Command")
+        if command == "query":
+            return self._reply(200, b"", {
+                "X-Goog-Upload-Status": session["status"],
+                "X-Goog-Upload-Size-Received": str(session["received"]),
+            })
+
+        finalize = command == "upload, finalize"
+        if command not in ("upload", "upload, finalize") or session["status"] != "active":
+            return self._reply(400, {"error": {"code": 400, "message": f"Unexpected command {command}"}})
+        if int(self.headers.get("X-Goog-Upload-Offset", -1)) != session["received"]:
+            return self._reply(400, {"error": {"code": 400, "message": "Offset does not match the bytes received"}})
+        if not finalize and len(body) % self.server.CHUNK_GRANULARITY:
+            return self._reply(400, {"error": {"code": 400, "message": "Chunk is not a multiple of the granularity"}})
+
+        session["received"] += len(body)
+        self.server.uploaded_bytes += len(body)
+        if not finalize:
+            return self._reply(200, b"", {"X-Goog-Upload-Status": "active"})
+
+        if session["received"] != session["size"]:
+            session["status"] = "cancelled"
+            return self._reply(400, {"error": {"code": 400, "message": "Size does not match the announced size"}})
+        session["status"] = "final"
+        self.server.uploads[session["name"]] = (session["content_type"], session["received"])
+        self._reply(200, uuid.uuid4().hex.encode(), {"X-Goog-Upload-Status": "final"})
+
+
+class TimedSession(requests.Session):
+    # records how long every request took, keyed by endpoint
+    def __init__(self, timings):
+        super().__init__()
+        self.timings = timings
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            # every resumable upload has its own session url, they are all timed as one endpoint
+            if "/upload-session/" in url:
+                endpoint = "http.upload_session"
+            else:
+                endpoint = "http." + url.rsplit("/", 1)[-1].split("?")[0]
+            self.timings.setdefault(endpoint, []).append(time.monotonic() - start)
+
+
+class SQLiteConnection:
+    # the part of a pymysql connection DBLog uses, on top of sqlite, errors are raised as the pymysql ones
+    # mysql would give for the same problem
+    def __init__(self, db, lock):
+        self._db = db
+        self._lock = lock
+
+    @contextmanager
+    def cursor(self):
+        with self._lock:
+            try:
+                yield self
+            except sqlite3.IntegrityError as e:
+                self._db.rollback()
+                raise pymysql.err.IntegrityError(str(e))
+            except sqlite3.OperationalError as e:
+                self._db.rollback()
+                if str(e).startswith(("no such table", "no such column", "table")):
+                    raise pymysql.err.ProgrammingError(str(e))
+                raise
+
+    def execute(self, statement, params=()):
+        self._db.execute(statement.replace("%s", "?"), tuple(map(str, params)))
+        self._db.commit()
+
+    def executemany(self, statement, params):
+        self._db.executemany(statement.replace("%s", "?"), [tuple(map(str, row)) for row in params])
+        self._db.commit()
+
+
+class SQLitePool:
+    # stands in for db_pool.ConnectionPool, DBLog creates the sensor tables itself and RecordedErrors is set up here
+    def __init__(self, db_file):
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("CREATE TABLE IF NOT EXISTS RecordedErrors (datetime_recorded TEXT, error_message TEXT)")
+
+    @contextmanager
+    def connection(self):
+        yield SQLiteConnection(self._db, self._lock)
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        self._db.close()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def make_backlog(photo_dir, count, rng):
+    # photos left on disk by earlier cycles, alternating between the cameras and a minute apart
+    start = datetime.now() - timedelta(minutes=count)
+    for i in range(count):
+        camera, prefix, size = (("ribbon", "Ribbon-Cam", RIBBON_JPEG_SIZE), ("usb", "USB-Cam", USB_JPEG_SIZE))[i % 2]
+        name = f"{prefix} {(start + timedelta(minutes=i)).strftime('%Y-%m-%d %H_%M_%S')}.jpg"
+        with open(os.path.join(photo_dir, camera, name), "wb") as f:
+            f.write(fake_jpeg(rng, size))
+
+
+def run(backlog, args):
+    rng = random.Random(args.seed)
+    timings = {}
+    stub = PhotosStub(latency=args.http_latency, failure_rate=args.http_failure_rate, seed=args.seed).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        photo_dir = os.path.join(tmp, "cam-photos")
+        for camera in ("ribbon", "usb"):
+            os.makedirs(os.path.join(photo_dir, camera))
+        make_backlog(photo_dir, backlog, rng)
+
+        gphotos = GPhoto(
+            upload_workers=args.upload_workers, resumable=args.resumable, api_url=stub.url, session=TimedSession(timings),
+            album_cache_file=os.path.join(tmp, "album_cache.json"),
+        )
+        sql_store = DBLog(flush_interval=1, backlog_file=os.path.join(tmp, "db_backlog.sqlite"))
+        sql_store.pool = SQLitePool(os.path.join(tmp, "bench.sqlite"))
+        webcam = Webcam(
+            "", photo_dir=photo_dir,
+            ribbon_camera=FakePiCamera(args.ribbon_latency, args.capture_failure_rate, args.seed),
+            usb_camera=FakeUSBCamera(args.usb_latency, args.capture_failure_rate, args.seed),
+        )
+
+        # every upload batch the background worker sends, with how many photos went in it
+        upload_and_remove_frames = gphotos.upload_and_remove_frames
+        uploaded = []
+
+        def timed_upload(frames, album_name, workers=None):
+            start = time.monotonic()
+            added = upload_and_remove_frames(frames, album_name, workers)
+            timings.setdefault("upload_batch", []).append(time.monotonic() - start)
+            uploaded.append(len(added))
+            return added
+
+        gphotos.upload_and_remove_frames = timed_upload
+
+        cycle_log = CycleLogHandler()
+        logging.getLogger().addHandler(cycle_log)
+        start = time.monotonic()
+        try:
+            resources = Resources(
+                gphotos=gphotos, sql_store=sql_store, webcam=webcam, spool_file=os.path.join(tmp, "spool.sqlite")
+            )
+            timings["startup"] = [time.monotonic() - start]
+
+            present_dt = datetime.now()
+            for _ in range(args.cycles):
+                cycle_start = time.monotonic()
+                # each cycle gets its own timestamp so the file names don't collide
+                present_dt += timedelta(seconds=300)
+                for stage, seconds in run_cycle(resources, cycle_log, present_dt).items():
+                    timings.setdefault(stage, []).append(seconds)
+                timings.setdefault("cycle", []).append(time.monotonic() - cycle_start)
+
+            # keep feeding the backlog through until the spool is empty or only holds failures in backoff
+            drain_start = time.monotonic()
+            while True:
+                resources.uploader.join()
+                before = resources.spool.pending_count()
+                resources.uploader.retry_due()
+                resources.uploader.join()
+                if resources.spool.pending_count() in (0, before):
+                    break
+            timings["drain"] = [time.monotonic() - drain_start]
+            left = resources.spool.pending_count()
+            resources.release()
+        finally:
+            logging.getLogger().removeHandler(cycle_log)
+            stub.stop()
+        elapsed = time.monotonic() - start
+
+    print(f"\nbacklog {backlog}, {args.cycles} cycles: {sum(uploaded)} photos uploaded in {elapsed:.2f} s "
+          f"({sum(uploaded) / elapsed:.1f} photos/s, {stub.uploaded_bytes / elapsed / 1e6:.1f} MB/s), "
+          f"{left} left in the spool")
+    print(f"{'stage':<28} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage, values in timings.items():
+        print(
+            f"{stage:<28} {len(values):>6} {percentile(values, 50) * 1e3:>9.1f} {percentile(values, 90) * 1e3:>9.1f} "
+            f"{percentile(values, 99) * 1e3:>9.1f} {max(values) * 1e3:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the timed_reads capture cycle against local stand-ins.")
+    parser.add_argument("--backlogs", default="0,50,200", help="comma separated numbers of photos already on disk")
+    parser.add_argument("--cycles", type=int, default=10, help="capture cycles run per backlog size")
+    parser.add_argument("--ribbon-latency", type=float, default=1.0, help="seconds a ribbon capture takes")
+    parser.add_argument("--usb-latency", type=float, default=0.2, help="seconds a usb capture takes")
+    parser.add_argument("--capture-failure-rate", type=float, default=0.0)
+    parser.add_argument("--http-latency", type=float, default=0.05, help="seconds every stub request takes")
+    parser.add_argument("--http-failure-rate", type=float, default=0.0)
+    parser.add_argument("--upload-workers", type=int, default=4)
+    parser.add_argument("--resumable", action="store_true",
+                        help="send the photos on disk with the chunked resumable protocol instead of in one request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="print the errors logged during the cycles")
+    args = parser.parse_args()
+
+    # warnings still have to reach the cycle log, they are only printed with --verbose
+    if args.verbose:
+        logging.basicConfig(level=logging.WARNING)
+    else:
+        logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.WARNING)
+    for backlog in (int(b) for b in args.backlogs.split(",")):
+        run(backlog, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import glob
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+from bench_cycle import PhotosStub
+from bench_transcode import sample_jpeg
+from frame import Frame
+from gphoto import GPhoto
+from timelapse import TimelapseEncoder
+
+
+def decoded_frames(ffprobe, clip):
+    # counts the frames that actually decode, not what the container header claims
+    completed_process = subprocess.run(
+        [
+            ffprobe, "-v", "error", "-count_frames", "-select_streams", "v:0",
+            "-show_entries", "stream=nb_read_frames", "-of", "csv=p=0", clip,
+        ],
+        capture_output=True, check=True,
+    )
+    return int(completed_process.stdout.decode().strip())
+
+
+def encode_day(output_dir, day, samples, args):
+    # the day's frames are split over several runs of the process, every run leaves its own segment
+    # behind and none of them reaches sunset, so the day is never joined while it is encoded
+    per_run = -(-args.frames // args.restarts)
+    for run in range(args.restarts):
+        encoder = TimelapseEncoder(
+            "bench", output_dir, fps=args.fps, resolution=tuple(args.resolution), ffmpeg=args.ffmpeg
+        )
+        for index in range(run * per_run, min(args.frames, (run + 1) * per_run)):
+            frame = Frame("bench", f"{index}.jpg", samples[index % len(samples)],
+                          captured_at=day + timedelta(seconds=index * 300))
+            if not encoder.append(frame):
+                raise SystemExit(f"Could not encode frame {index} of {day:%Y-%m-%d}")
+        encoder._close_segment()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Encode synthetic frames into time-lapses across restarts and missed sunsets, then check "
+                    "that every day is joined into one clip and uploaded with its content type."
+    )
+    parser.add_argument("--days", type=int, default=3, help="days left on disk without being joined")
+    parser.add_argument("--frames", type=int, default=48, help="frames per day")
+    parser.add_argument("--restarts", type=int, default=3, help="runs of the process per day, one segment each")
+    parser.add_argument("--samples", type=int, default=6, help="distinct synthetic frames, reused in turn")
+    parser.add_argument("--resolution", type=int, nargs=2, default=(640, 360), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--fps", type=int, default=24)
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--ffprobe", default="ffprobe")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    samples = [sample_jpeg(tuple(args.resolution), 90, seed) for seed in range(args.samples)]
+    first_day = datetime.now().replace(hour=6, minute=0, second=0, microsecond=0) - timedelta(days=args.days)
+
+    stub = PhotosStub(latency=0).start()
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            for offset in range(args.days):
+                encode_day(output_dir, first_day + timedelta(days=offset), samples, args)
+            encode_seconds = time.perf_counter() - start
+
+            # what Resources does on startup, every day left behind is joined in one go
+            start = time.perf_counter()
+            clips = TimelapseEncoder("bench", output_dir, ffmpeg=args.ffmpeg).finish_all()
+            join_seconds = time.perf_counter() - start
+
+            gphotos = GPhoto(api_url=stub.url, session=requests.Session(),
+                             album_cache_file=os.path.join(output_dir, "album_cache.json"))
+            tokens = [gphotos._upload_bytes(clip) for clip in clips]
+
+            problems = []
+            if len(clips) != args.days:
+                problems.append(f"{len(clips)} clips joined for {args.days} days")
+            leftovers = glob.glob(os.path.join(output_dir, "*.mkv"))
+            if leftovers:
+                problems.append(f"{len(leftovers)} segments were not joined")
+            print(f"{'clip':<24} {'frames':>7} {'KB':>8} {'content type':>14}")
+            for clip, token in zip(clips, tokens):
+                frames = decoded_frames(args.ffprobe, clip)
+                content_type, size = stub.uploads.get(os.path.basename(clip), (None, 0))
+                print(f"{os.path.basename(clip):<24} {frames:>7} {os.path.getsize(clip) / 1e3:>8.0f} "
+                      f"{str(content_type):>14}")
+                if frames != args.frames:
+                    problems.append(f"{os.path.basename(clip)} has {frames} frames, expected {args.frames}")
+                if not token or content_type != "video/mp4" or size != os.path.getsize(clip):
+                    problems.append(f"{os.path.basename(clip)} was not uploaded whole as video/mp4")
+    finally:
+        stub.stop()
+
+    total = args.days * args.frames
+    print(f"encoded {total} frames in {args.days * args.restarts} segments, "
+          f"{encode_seconds / total * 1e3:.1f} ms/frame, joined in {join_seconds:.2f} s")
+    if problems:
+        raise SystemExit("\n".join(problems))
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from transcode import transcode_jpeg
+
+
+# the two cameras as they are captured, resolution and the quality their jpgs come out at
+CAMERAS = {
+    "ribbon": ((3280, 2464), 85),
+    "usb": ((1920, 1080), 90),
+}
+
+
+def sample_jpeg(resolution, quality, seed):
+    # a smooth gradient with some blobs and sensor noise, compresses roughly like a photo of a tank
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([
+        80 + 60 * np.sin(x / width * 3 + seed) + 40 * (y / height),
+        120 + 50 * np.cos(y / height * 4),
+        150 + 40 * np.sin((x + y) / (width + height) * 6),
+    ], axis=-1)
+    for _ in range(30):
+        cx, cy, r = rng.integers(0, width), rng.integers(0, height), rng.integers(20, height // 6)
+        image[(x - cx) ** 2 + (y - cy) ** 2 < r * r] += rng.integers(-60, 60, 3)
+    image += rng.normal(0, 4, image.shape)
+
+    exif = Image.Exif()
+    exif[0x010F] = "RaspberryPi"
+    exif[0x0110] = "bench"
+    out = io.BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(
+        out, format="JPEG", quality=quality, exif=exif.tobytes()
+    )
+    return out.getvalue()
+
+
+def bench_camera(camera, frames, args, pool):
+    resolution, capture_quality = CAMERAS[camera]
+    samples = [sample_jpeg(resolution, capture_quality, seed) for seed in range(frames)]
+    max_size = tuple(args.max_size)
+
+    # one frame at a time in this process, the cost per frame on one core
+    results = [transcode_jpeg(data, max_size, args.quality, args.progressive) for data in samples]
+    per_frame = sum(seconds for _, seconds in results) / frames
+
+    # all frames through the pool, the throughput the transcode stage gets with every core
+    start = time.perf_counter()
+    list(pool.map(transcode_jpeg, samples, [max_size] * frames, [args.quality] * frames,
+                  [args.progressive] * frames))
+    pool_per_frame = (time.perf_counter() - start) / frames
+
+    original = sum(len(data) for data in samples) / frames
+    transcoded = sum(len(data) for data, _ in results) / frames
+    exif_kept = all(Image.open(io.BytesIO(data)).info.get("exif") for data, _ in results)
+    print(
+        f"{camera:<7} {original / 1e3:>9.0f} {transcoded / 1e3:>9.0f} {1 - transcoded / original:>7.0%} "
+        f"{per_frame * 1e3:>10.1f} {pool_per_frame * 1e3:>11.1f} {str(exif_kept):>5}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the transcode stage on synthetic camera frames.")
+    parser.add_argument("--frames", type=int, default=8, help="frames per camera")
+    parser.add_argument("--max-size", type=int, nargs=2, default=(1920, 1080), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--progressive", action="store_true")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    print(f"max size {args.max_size[0]}x{args.max_size[1]}, quality {args.quality}, "
+          f"progressive {args.progressive}, {args.workers} workers")
+    print(f"{'camera':<7} {'orig KB':>9} {'new KB':>9} {'saved':>7} {'ms/frame':>10} {'pool ms/fr':>11} {'exif':>5}")
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for camera in CAMERAS:
+            bench_camera(camera, args.frames, args, pool)
+
+
+if __name__ == "__main__":
+    main()
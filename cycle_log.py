@@ -0,0 +1,64 @@
+import logging
+from collections import deque
+from datetime import datetime
+
+
+class CycleLogRecord:
+    __slots__ = ("created", "level", "logger", "message", "exception")
+
+    def __init__(self, created, level, logger, message, exception):
+        self.created = created
+        self.level = level
+        self.logger = logger
+        self.message = message
+        self.exception = exception
+
+    def __str__(self):
+        text = f"{self.level} {self.logger}: {self.message}"
+        if self.exception:
+            text += "\n" + self.exception
+        return text
+
+
+class CycleLogHandler(logging.Handler):
+    # collects the records of one capture cycle in memory so they can be stored as rows in the database
+    def __init__(self, capacity=500, level=logging.WARNING):
+        super().__init__(level)
+        self._records = deque(maxlen=capacity)
+        self._formatter = logging.Formatter()
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            exception = None
+            if record.exc_info:
+                exception = self._formatter.formatException(record.exc_info)
+
+            # the oldest record is pushed out when the buffer is full
+            if len(self._records) == self._records.maxlen:
+                self.dropped += 1
+
+            self._records.append(
+                CycleLogRecord(
+                    datetime.fromtimestamp(record.created),
+                    record.levelname,
+                    record.name,
+                    record.getMessage(),
+                    exception,
+                )
+            )
+        except Exception:
+            self.handleError(record)
+
+    def drain(self):
+        self.acquire()
+        try:
+            records = list(self._records)
+            self._records.clear()
+            dropped, self.dropped = self.dropped, 0
+        finally:
+            self.release()
+
+        if dropped:
+            logging.warning(f"{dropped} log records were dropped from the cycle log buffer")
+        return records
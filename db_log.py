@@ -1,41 +1,361 @@
 import os
 import json
 import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
 import pymysql
+from pymysql.constants import ER
+
+import metrics
+from db_pool import ConnectionPool
+from sensor_buffer import SensorRingBuffer
 
 
 class DBLog:
-    def __init__(self):
-        self.conn = None
+    # rows sent to the database in one executemany call
+    FLUSH_BATCH = 500
+    # rows kept on disk while the database is unreachable, the oldest are dropped beyond this
+    BACKLOG_LIMIT = 100000
+    # rows the database rejected outright, kept for inspection
+    QUARANTINE_LIMIT = 10000
+    # errors that will happen again however often the row is retried (missing table, bad data), anything
+    # else is taken as the connection being down
+    PERMANENT_ERRORS = (
+        pymysql.err.ProgrammingError,
+        pymysql.err.IntegrityError,
+        pymysql.err.DataError,
+        pymysql.err.NotSupportedError,
+    )
+    # the sensor tables are created on the first connection, RecordedErrors is set up with the database itself
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS SensorReadings (
+            sensor VARCHAR(64) NOT NULL,
+            datetime_recorded DATETIME(3) NOT NULL,
+            value DOUBLE NOT NULL,
+            PRIMARY KEY (sensor, datetime_recorded)
+        )""",
+        """CREATE TABLE IF NOT EXISTS SensorAggregates (
+            sensor VARCHAR(64) NOT NULL,
+            window_start DATETIME NOT NULL,
+            window_seconds INT NOT NULL,
+            sample_count INT NOT NULL,
+            min_value DOUBLE NOT NULL,
+            max_value DOUBLE NOT NULL,
+            mean_value DOUBLE NOT NULL,
+            last_value DOUBLE NOT NULL,
+            PRIMARY KEY (sensor, window_start, window_seconds)
+        )""",
+    )
+    # mysql error codes for a user that may not create tables, retrying won't change that
+    SCHEMA_DENIED = (ER.DBACCESS_DENIED_ERROR, ER.TABLEACCESS_DENIED_ERROR)
+
+    def __init__(self, flush_interval=10, backlog_file=None, sensor_flush_interval=60, sensor_buffer_size=4096,
+                 sensor_aggregator=None):
+        self.pool = None
+        # sensor name -> ring buffer of readings not yet written to SensorReadings
         self.local_sensor_data = {}
+        # when set, only window summaries and the raw samples around anomalies are stored
+        self.sensor_aggregator = sensor_aggregator
+        self.sensor_flush_interval = sensor_flush_interval
+        self.sensor_buffer_size = sensor_buffer_size
+        self._sensor_lock = threading.Lock()
+        self._last_sensor_flush = time.monotonic()
+
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.flush_interval = flush_interval
+
+        # rows wait here until the writer thread sends them, the capture loop never talks to mysql itself
+        self._rows = queue.Queue()
+        self._backlog_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._stopping = threading.Event()
+
+        # rows that could not be written are kept on disk and replayed in order once the database is back
+        self._backlog = sqlite3.connect(
+            backlog_file or os.path.join(dir_path, "db_backlog.sqlite"), check_same_thread=False
+        )
+        self._backlog.execute(
+            "CREATE TABLE IF NOT EXISTS backlog (id INTEGER PRIMARY KEY, statement TEXT NOT NULL, params TEXT NOT NULL)"
+        )
+        self._backlog.execute(
+            "CREATE TABLE IF NOT EXISTS quarantine (id INTEGER PRIMARY KEY, statement TEXT NOT NULL, "
+            "params TEXT NOT NULL, error TEXT NOT NULL, quarantined_at REAL NOT NULL)"
+        )
+        self._backlog.commit()
+        self._schema_ready = False
+
+        self.rows_written = 0
+        self.rows_spilled = 0
+        self.rows_replayed = 0
+        self.rows_quarantined = 0
+        self.rows_dropped = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+        self._writer = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._writer.start()
 
     def connect_to_db(self):
+        # connections are only opened when the writer needs one, and are health checked before each use
         dir_path = os.path.dirname(os.path.realpath(__file__))
-        if self.conn is not None and self.conn.open:
-            self.conn.close()
-        with open(os.path.join(dir_path, 'connection_info.json')) as conn_file:
-            data = json.load(conn_file)["connection"]
-            try:
-                self.conn = pymysql.connect(
-                    host=data["host"],
-                    user=data["user"],
-                    password=data["password"],
-                    db=data["db"],
-                    charset="utf8mb4",
-                    connect_timeout=60,
-                    read_timeout=30,
-                    write_timeout=30,
-                    autocommit=True,
-                    cursorclass=pymysql.cursors.DictCursor,
-                )
-            except BaseException as e:
-                logging.exception("Could not create a connection to the database in connect_to_db() function \n\n")
-                logging.debug('Failed to connect to DB')
+        if self.pool is not None:
+            self.pool.close()
+        self.pool = ConnectionPool(os.path.join(dir_path, 'connection_info.json'))
+
+    def stats(self):
+        pool_stats = self.pool.stats() if self.pool is not None else {}
+        return {
+            **pool_stats,
+            "queue_depth": self._rows.qsize(),
+            "backlog_depth": self._backlog_depth(),
+            "rows_written": self.rows_written,
+            "rows_spilled": self.rows_spilled,
+            "rows_replayed": self.rows_replayed,
+            "rows_quarantined": self.rows_quarantined,
+            "rows_dropped": self.rows_dropped,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+        }
 
     def insert_error(self, dt, error):
         insert_statement = f"""INSERT INTO RecordedErrors(datetime_recorded,error_message) VALUES (%s, %s)"""
+        self._queue_row(insert_statement, (dt, error[:16777214]))
+
+    def record_sensor(self, sensor, value, timestamp=None):
+        # cheap enough to call every few seconds, the readings are written in bulk every sensor_flush_interval
+        with self._sensor_lock:
+            buffer = self.local_sensor_data.get(sensor)
+            if buffer is None:
+                buffer = self.local_sensor_data[sensor] = SensorRingBuffer(self.sensor_buffer_size)
+            buffer.append(value, timestamp)
+
+    def _drain_sensors(self):
+        insert_statement = """INSERT INTO SensorReadings(sensor,datetime_recorded,value) VALUES (%s, %s, %s)"""
+        aggregate_statement = """INSERT INTO SensorAggregates(sensor,window_start,window_seconds,sample_count,min_value,max_value,mean_value,last_value) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
+        rows = []
+        with self._sensor_lock:
+            for sensor, buffer in self.local_sensor_data.items():
+                if buffer.dropped:
+                    logging.warning(f"Sensor buffer for {sensor} was full, {buffer.dropped} readings were dropped")
+                    buffer.dropped = 0
+                timestamps, values = buffer.drain()
+
+                if self.sensor_aggregator is not None:
+                    try:
+                        windows, raw = self.sensor_aggregator.process(
+                            sensor, timestamps, values, final=self._stopping.is_set()
+                        )
+                    except Exception:
+                        # the readings are already out of the buffer, they are stored raw rather than lost
+                        logging.exception(f"Could not aggregate the {sensor} readings, storing them as they are")
+                        windows, raw = [], (timestamps, values)
+                    timestamps, values = raw
+                    rows.extend(
+                        (aggregate_statement, (
+                            sensor, datetime.fromtimestamp(w.window_start), self.sensor_aggregator.window,
+                            w.count, w.minimum, w.maximum, w.mean, w.last,
+                        ))
+                        for w in windows
+                    )
+
+                rows.extend(
+                    (insert_statement, (sensor, datetime.fromtimestamp(timestamp), float(value)))
+                    for timestamp, value in zip(timestamps, values)
+                )
+        return rows
+
+    def _queue_row(self, statement, params):
+        self._rows.put((statement, params))
+
+    def flush(self):
+        # asks the writer thread to send everything that is queued now instead of at the next interval
+        self._flush_requested.set()
+
+    def close(self):
+        self._stopping.set()
+        self._flush_requested.set()
+        self._writer.join()
+        if self.pool is not None:
+            self.pool.close()
+        with self._backlog_lock:
+            self._backlog.close()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self._flush()
+            except BaseException:
+                logging.exception("The database writer failed to flush its rows")
+
+        # last flush on the way out, whatever can't be written stays in the backlog for the next start
+        try:
+            self._flush()
+        except BaseException:
+            logging.exception("The database writer failed to flush its rows")
+
+    def _drain(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self._rows.get_nowait())
+            except queue.Empty:
+                return rows
+
+    def _flush(self):
+        rows = self._drain()
+
+        # sensor readings go out as one multi-row insert per batch, pymysql folds executemany into one statement
+        if self._stopping.is_set() or time.monotonic() - self._last_sensor_flush >= self.sensor_flush_interval:
+            self._last_sensor_flush = time.monotonic()
+            try:
+                rows.extend(self._drain_sensors())
+            except BaseException:
+                # the queue was drained already, its rows must not go down with the sensor readings
+                self._spill(rows)
+                raise
+        if not rows and not self._backlog_depth():
+            return
+
+        start = time.monotonic()
+
+        if self.pool is None:
+            self.connect_to_db()
+
+        done = 0
+        rows_written = self.rows_written
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute(insert_statement, (dt, error[:16777214]))
+            with self.pool.connection() as conn:
+                if not self._schema_ready:
+                    self._create_tables(conn)
+                # the backlog is older than anything in the queue, it has to go first to keep the order
+                if self._replay_backlog(conn):
+                    done = self._write(conn, rows)
         except BaseException as e:
-            logging.debug('Failed to insert the error into recordedErrors table')
+            logging.debug(f'Failed to write to the database -- {e}')
+
+        if done < len(rows):
+            self._spill(rows[done:])
+
+        self.last_flush_seconds = time.monotonic() - start
+        self.max_flush_seconds = max(self.max_flush_seconds, self.last_flush_seconds)
+        metrics.observe("db_flush_seconds", self.last_flush_seconds)
+        metrics.count("db_rows_written_total", self.rows_written - rows_written)
+        metrics.count("db_rows_spilled_total", len(rows) - done)
+
+    def _create_tables(self, conn):
+        # a connection error propagates and the rows are spilled, the tables are tried again on the next flush
+        try:
+            with conn.cursor() as cursor:
+                for statement in self.SCHEMA:
+                    cursor.execute(statement)
+        except pymysql.err.MySQLError as e:
+            if not isinstance(e, self.PERMANENT_ERRORS) and (not e.args or e.args[0] not in self.SCHEMA_DENIED):
+                raise
+            logging.error(f"Could not create the sensor tables, rows for a missing table will be quarantined -- {e}")
+        self._schema_ready = True
+
+    def _write(self, conn, rows):
+        # sends rows in order, consecutive rows with the same statement go in one executemany call,
+        # returns how many rows were dealt with, i.e. written or quarantined
+        done = 0
+        while done < len(rows):
+            statement = rows[done][0]
+            end = done
+            while end < len(rows) and end - done < self.FLUSH_BATCH and rows[end][0] == statement:
+                end += 1
+
+            try:
+                with conn.cursor() as cursor:
+                    cursor.executemany(statement, [params for _, params in rows[done:end]])
+            except self.PERMANENT_ERRORS:
+                # one bad row fails the whole batch, send it row by row to find the bad ones
+                done += self._write_singly(conn, rows[done:end])
+                if done < end:
+                    break
+                continue
+            except BaseException as e:
+                logging.debug(f'Failed to write {end - done} rows to the database -- {e}')
+                break
+
+            self.rows_written += end - done
+            done = end
+
+        return done
+
+    def _write_singly(self, conn, rows):
+        for i, (statement, params) in enumerate(rows):
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(statement, params)
+            except self.PERMANENT_ERRORS as e:
+                self._quarantine(statement, params, e)
+                continue
+            except BaseException as e:
+                logging.debug(f'Failed to write a row to the database -- {e}')
+                return i
+            self.rows_written += 1
+        return len(rows)
+
+    def _quarantine(self, statement, params, error):
+        # a row the database rejects would block every row behind it forever, it is set aside instead
+        logging.error(f"The database rejected a row, moving it to the quarantine -- {error}\n{statement} {params}")
+        with self._backlog_lock:
+            self._backlog.execute(
+                "INSERT INTO quarantine(statement, params, error, quarantined_at) VALUES (?, ?, ?, ?)",
+                (statement, json.dumps(params, default=str), str(error), time.time()),
+            )
+            self._backlog.execute(
+                "DELETE FROM quarantine WHERE id <= (SELECT MAX(id) FROM quarantine) - ?", (self.QUARANTINE_LIMIT,)
+            )
+            self._backlog.commit()
+        self.rows_quarantined += 1
+        metrics.count("db_rows_quarantined_total")
+
+    def _spill(self, rows):
+        with self._backlog_lock:
+            self._backlog.executemany(
+                "INSERT INTO backlog(statement, params) VALUES (?, ?)",
+                [(statement, json.dumps(params, default=str)) for statement, params in rows],
+            )
+            # an outage long enough to fill the backlog loses the oldest rows rather than the sd card
+            depth = self._backlog.execute("SELECT COUNT(*) FROM backlog").fetchone()[0]
+            dropped = max(0, depth - self.BACKLOG_LIMIT)
+            if dropped:
+                self._backlog.execute(
+                    "DELETE FROM backlog WHERE id IN (SELECT id FROM backlog ORDER BY id LIMIT ?)", (dropped,)
+                )
+            self._backlog.commit()
+        self.rows_spilled += len(rows)
+        if dropped:
+            self.rows_dropped += dropped
+            logging.error(f"The database backlog is full, dropped the {dropped} oldest rows")
+
+    def _backlog_depth(self):
+        with self._backlog_lock:
+            return self._backlog.execute("SELECT COUNT(*) FROM backlog").fetchone()[0]
+
+    def _replay_backlog(self, conn):
+        # returns True once the backlog is empty
+        while True:
+            with self._backlog_lock:
+                backlog = self._backlog.execute(
+                    "SELECT id, statement, params FROM backlog ORDER BY id LIMIT ?", (self.FLUSH_BATCH,)
+                ).fetchall()
+            if not backlog:
+                return True
+
+            rows = [(statement, tuple(json.loads(params))) for _, statement, params in backlog]
+            done = self._write(conn, rows)
+            if done:
+                with self._backlog_lock:
+                    self._backlog.execute("DELETE FROM backlog WHERE id <= ?", (backlog[done - 1][0],))
+                    self._backlog.commit()
+                self.rows_replayed += done
+            if done < len(rows):
+                return False
@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+
+
+# parsed connection_info.json files, keyed by path and only re-read when the file changes
+_config_cache = {}
+
+
+def load_connection_info(config_file):
+    mtime = os.path.getmtime(config_file)
+    cached = _config_cache.get(config_file)
+    if cached is None or cached[0] != mtime:
+        with open(config_file) as conn_file:
+            cached = (mtime, json.load(conn_file)["connection"])
+        _config_cache[config_file] = cached
+    return cached[1]
+
+
+class ConnectionPool:
+    def __init__(self, config_file, max_connections=3, acquire_timeout=30, backoff_base=1, backoff_max=300):
+        self.config_file = config_file
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._idle = []
+        self._open_count = 0
+        self._available = threading.Condition()
+
+        self._failures = 0
+        self._next_attempt = 0.0
+
+        self.connects = 0
+        self.reconnects = 0
+        self.last_connect_seconds = 0.0
+        self.max_connect_seconds = 0.0
+
+    def stats(self):
+        with self._available:
+            return {
+                "open_connections": self._open_count,
+                "idle_connections": len(self._idle),
+                "connects": self.connects,
+                "reconnects": self.reconnects,
+                "last_connect_seconds": self.last_connect_seconds,
+                "max_connect_seconds": self.max_connect_seconds,
+            }
+
+    def _connect(self):
+        # after a failure new attempts are spaced out with a doubling delay instead of hammering the server
+        if time.monotonic() < self._next_attempt:
+            raise ConnectionError(
+                f"Not connecting to the database for another {self._next_attempt - time.monotonic():.0f} seconds"
+            )
+
+        data = load_connection_info(self.config_file)
+        start = time.monotonic()
+        try:
+            conn = pymysql.connect(
+                host=data["host"],
+                user=data["user"],
+                password=data["password"],
+                db=data["db"],
+                charset="utf8mb4",
+                connect_timeout=60,
+                read_timeout=30,
+                write_timeout=30,
+                autocommit=True,
+                cursorclass=pymysql.cursors.DictCursor,
+            )
+        except BaseException as e:
+            self._failures += 1
+            delay = min(self.backoff_base * 2 ** (self._failures - 1), self.backoff_max)
+            self._next_attempt = time.monotonic() + delay
+            logging.error(f"Could not create a connection to the database, retrying in {delay} seconds -- {e}")
+            raise
+
+        self.last_connect_seconds = time.monotonic() - start
+        self.max_connect_seconds = max(self.max_connect_seconds, self.last_connect_seconds)
+        self.connects += 1
+        if self._failures:
+            self.reconnects += 1
+        self._failures = 0
+        return conn
+
+    def _healthy(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except BaseException:
+            return False
+
+    def _acquire(self):
+        with self._available:
+            deadline = time.monotonic() + self.acquire_timeout
+            while not self._idle and self._open_count >= self.max_connections:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("No database connection became available")
+                self._available.wait(remaining)
+
+            conn = self._idle.pop() if self._idle else None
+            # the slot is reserved before connecting so other threads don't overshoot max_connections
+            if conn is None:
+                self._open_count += 1
+
+        if conn is not None:
+            if self._healthy(conn):
+                return conn
+            logging.info("Pooled database connection was dropped, reconnecting")
+            self.reconnects += 1
+            self._close_quietly(conn)
+
+        try:
+            return self._connect()
+        except BaseException:
+            self._discard()
+            raise
+
+    def _release(self, conn):
+        with self._available:
+            self._idle.append(conn)
+            self._available.notify()
+
+    def _discard(self):
+        with self._available:
+            self._open_count -= 1
+            self._available.notify()
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except BaseException:
+            pass
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except BaseException:
+            # the connection may be half way through a failed statement, don't hand it out again
+            self._close_quietly(conn)
+            self._discard()
+            raise
+        else:
+            self._release(conn)
+
+    def close(self):
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+        for conn in idle:
+            self._close_quietly(conn)
@@ -0,0 +1,61 @@
+import logging
+import os
+
+from atomic_file import write_atomic
+
+
+class Frame:
+    def __init__(self, camera, path, data=None, captured_at=None, job_id=None):
+        self.camera = camera
+        # where the jpg lives on disk, or where it gets written to if it has to be spilled
+        self.path = path
+        # jpg bytes while the frame only exists in memory
+        self.data = data
+        self.captured_at = captured_at
+        # upload spool job this frame is being retried for, if any
+        self.job_id = job_id
+        # id of the media item in google photos once the frame was added to the library
+        self.remote_id = None
+
+    @classmethod
+    def from_file(cls, camera, path):
+        return cls(camera, path)
+
+    @property
+    def file_name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def in_memory(self):
+        return self.data is not None
+
+    def read(self):
+        if self.data is not None:
+            return self.data
+        with open(self.path, mode="rb") as f:
+            return f.read()
+
+    def spill(self):
+        # only called when the upload failed or the process is going down, on the happy path
+        # the frame never touches the sd card
+        if self.data is None:
+            return True
+
+        try:
+            write_atomic(self.path, self.data)
+        except OSError:
+            logging.exception(f"Could not write {self.path} to disk, the photo is lost")
+            return False
+
+        self.data = None
+        return True
+
+    def discard(self):
+        if self.data is not None:
+            self.data = None
+            return
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            logging.exception(f"Could not remove {self.path} after uploading it")
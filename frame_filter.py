@@ -0,0 +1,150 @@
+import io
+import json
+import logging
+import os
+import time
+from collections import deque
+
+import numpy as np
+from PIL import Image
+
+import metrics
+
+
+class FilterDecision:
+    __slots__ = ("camera", "file_name", "keep", "reason", "score", "decided_at")
+
+    def __init__(self, camera, file_name, keep, reason, score=None):
+        self.camera = camera
+        self.file_name = file_name
+        self.keep = keep
+        # why the frame was kept or skipped, e.g. "changed", "unchanged", "keep every", "max gap"
+        self.reason = reason
+        # how far the frame was from the last kept one, in the units of the metric
+        self.score = score
+        self.decided_at = time.time()
+
+    def to_json(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+def thumbnail(data, size):
+    '''
+    small grayscale version of a jpg as a float array. the jpg decoder is
+    asked for a reduced scale up front, so the full frame is never decoded
+    '''
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", size)
+    return np.asarray(image.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def mean_absolute_difference(a, b):
+    # 0 for identical thumbnails, up to 255
+    return float(np.abs(a - b).mean())
+
+
+def difference_hash(image):
+    # one bit per pixel, set where the pixel is brighter than its right neighbour
+    return image[:, 1:] > image[:, :-1]
+
+
+def hash_distance(a, b):
+    # share of differing hash bits, 0 for identical frames and around 0.5 for unrelated ones
+    return float(np.count_nonzero(difference_hash(a) != difference_hash(b))) / a[:, 1:].size
+
+
+class FrameFilter:
+    '''
+    skips frames that barely changed since the last kept frame of the same
+    camera. a frame is always kept if keep_every - 1 frames in a row were
+    skipped before it, or if the last kept frame is older than max_gap
+    seconds. skipped frames are dropped, or moved to demote_dir when it is
+    set. every decision is kept in decisions, skips are also appended to
+    log_file as json lines
+    '''
+    METRICS = {
+        # thumbnail size, distance function
+        "mad": ((64, 48), mean_absolute_difference),
+        "dhash": ((9, 8), hash_distance),
+    }
+
+    def __init__(self, threshold=3.0, metric="mad", keep_every=12, max_gap=3600, demote_dir=None, log_file=None,
+                 history=500):
+        if metric not in self.METRICS:
+            raise ValueError(f"Unknown frame filter metric {metric}, expected one of {', '.join(self.METRICS)}")
+        self.threshold = threshold
+        self.metric = metric
+        self.thumbnail_size, self._distance = self.METRICS[metric]
+        self.keep_every = keep_every
+        self.max_gap = max_gap
+        self.demote_dir = demote_dir
+        self.log_file = log_file
+        self.decisions = deque(maxlen=history)
+
+        # camera -> (thumbnail, time) of the last kept frame, and the frames skipped since then
+        self._reference = {}
+        self._skipped = {}
+
+    def _decide(self, frame):
+        try:
+            current = thumbnail(frame.read(), self.thumbnail_size)
+        except Exception as e:
+            # a frame that can't be decoded is uploaded anyway, the filter must never lose a photo on its own
+            logging.warning(f"Could not make a thumbnail of {frame.file_name}, keeping it -- {e}")
+            return FilterDecision(frame.camera, frame.file_name, True, "unreadable"), None
+
+        reference = self._reference.get(frame.camera)
+        if reference is None:
+            return FilterDecision(frame.camera, frame.file_name, True, "first frame"), current
+
+        score = self._distance(current, reference[0])
+        if score >= self.threshold:
+            return FilterDecision(frame.camera, frame.file_name, True, "changed", score), current
+        if self._skipped.get(frame.camera, 0) + 1 >= self.keep_every:
+            return FilterDecision(frame.camera, frame.file_name, True, "keep every", score), current
+        if time.time() - reference[1] >= self.max_gap:
+            return FilterDecision(frame.camera, frame.file_name, True, "max gap", score), current
+        return FilterDecision(frame.camera, frame.file_name, False, "unchanged", score), current
+
+    def keep(self, frame):
+        '''
+        returns True if the frame should be uploaded, a skipped frame has
+        already been dropped or demoted when this returns
+        '''
+        decision, current = self._decide(frame)
+        self.decisions.append(decision)
+        metrics.count("frames_filtered_total", camera=frame.camera, reason=decision.reason)
+
+        if decision.keep:
+            if current is not None:
+                self._reference[frame.camera] = (current, time.time())
+            self._skipped[frame.camera] = 0
+            return True
+
+        self._skipped[frame.camera] = self._skipped.get(frame.camera, 0) + 1
+        self._record(decision)
+        if self.demote_dir:
+            self._demote(frame)
+        else:
+            frame.discard()
+        return False
+
+    def _demote(self, frame):
+        path = os.path.join(self.demote_dir, frame.file_name)
+        if frame.in_memory:
+            frame.path = path
+            frame.spill()
+            return
+        try:
+            os.replace(frame.path, path)
+        except OSError:
+            logging.exception(f"Could not move {frame.path} to {self.demote_dir}")
+
+    def _record(self, decision):
+        if not self.log_file:
+            return
+        try:
+            with open(self.log_file, "a") as f:
+                f.write(json.dumps(decision.to_json()) + "\n")
+        except OSError as err:
+            logging.error(f"Could not record the skipped frame {decision.file_name} - {err}")
@@ -1,17 +1,51 @@
 import argparse
 import json
 import logging
+import mimetypes
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+import metrics
+from atomic_file import write_atomic
+from frame import Frame
+
 
 class GPhoto:
-    def __init__(self):
+    # maximum number of newMediaItems the api accepts in one mediaItems:batchCreate call
+    BATCH_CREATE_LIMIT = 50
+    API_URL = "https://photoslibrary.googleapis.com/v1"
+    # bytes sent per request in resumable mode, rounded up to the chunk granularity the server asks for
+    RESUMABLE_CHUNK_SIZE = 1024 * 1024
+    # (connect, read) seconds for every request, a stalled connection must not hold the upload worker forever
+    REQUEST_TIMEOUT = (15, 120)
+
+    def __init__(self, upload_workers=1, resumable=False, chunk_size=RESUMABLE_CHUNK_SIZE, api_url=API_URL,
+                 session=None, album_cache_file=None):
+        self.upload_workers = upload_workers
+        self.resumable = resumable
+        self.chunk_size = chunk_size
+        self.api_url = api_url
         self.dir_path = os.path.dirname(os.path.realpath(__file__))
-        self._session = self._get_authorized_session(os.path.join(self.dir_path, 'client_id.json'))
+        self.album_cache_file = album_cache_file or os.path.join(self.dir_path, "album_cache.json")
+        self._album_ids = self._load_album_cache()
+        # a requests.Session can be passed in to talk to something other than google, e.g. a local stub
+        self._session = session or self._get_authorized_session(os.path.join(self.dir_path, 'client_id.json'))
+        self._session.hooks["response"].append(self._record_request)
+
+    def _record_request(self, resp, *args, **kwargs):
+        # resumable session urls are unique per upload, they are all counted as one endpoint
+        if not metrics.enabled():
+            return
+        url = resp.request.url.split("?")[0]
+        endpoint = url[len(self.api_url) + 1:] if url.startswith(self.api_url + "/") else "upload_session"
+        labels = {"endpoint": endpoint, "status": resp.status_code}
+        metrics.observe("http_request_seconds", resp.elapsed.total_seconds(), **labels)
+        metrics.count("http_requests_total", **labels)
 
     def auth(self, scopes):
         flow = InstalledAppFlow.from_client_secrets_file(
@@ -76,7 +110,7 @@ class GPhoto:
         params = {"excludeNonAppCreatedData": app_created_only}
         while True:
             albums = self._session.get(
-                "https://photoslibrary.googleapis.com/v1/albums", params=params
+                f"{self.api_url}/albums", params=params, timeout=self.REQUEST_TIMEOUT
             ).json()
 
             logging.debug("Server response: {}".format(albums))
@@ -91,7 +125,39 @@ class GPhoto:
             else:
                 return
 
+    def _load_album_cache(self):
+        try:
+            with open(self.album_cache_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception(f"Could not load the album cache {self.album_cache_file}, starting with an empty one\n")
+            return {}
+
+    def _save_album_cache(self):
+        try:
+            write_atomic(self.album_cache_file, json.dumps(self._album_ids))
+        except OSError as err:
+            logging.error(f"Could not save the album cache - {err}")
+
+    def forget_album(self, album_title):
+        if self._album_ids.pop(album_title.lower(), None) is not None:
+            self._save_album_cache()
+
     def create_or_retrieve_album(self, album_title):
+        album_id = self._album_ids.get(album_title.lower())
+        if album_id:
+            return album_id
+
+        with metrics.timer("album_lookup_seconds"):
+            album_id = self._find_or_create_album(album_title)
+        if album_id:
+            self._album_ids[album_title.lower()] = album_id
+            self._save_album_cache()
+        return album_id
+
+    def _find_or_create_album(self, album_title):
 
         # Find albums created by this app to see if one matches album_title
         for a in self.get_albums(True):
@@ -103,7 +169,7 @@ class GPhoto:
         # No matches, create new album
         create_album_body = json.dumps({"album": {"title": album_title}})
         resp = self._session.post(
-            "https://photoslibrary.googleapis.com/v1/albums", create_album_body
+            f"{self.api_url}/albums", create_album_body, timeout=self.REQUEST_TIMEOUT
         ).json()
         logging.debug(f"Server response: {resp}")
 
@@ -116,92 +182,301 @@ class GPhoto:
             )
             return None
 
-    def upload_photos(self, photo_file_name, album_name):
-
-        album_id = self.create_or_retrieve_album(album_name) if album_name else None
+    def _upload_bytes(self, photo_file_name, photo_bytes=None):
+        # the headers are passed per request so several uploads can share the session at once
+        headers = {
+            "Content-type": "application/octet-stream",
+            "X-Goog-Upload-Content-Type": mimetypes.guess_type(photo_file_name)[0] or "image/jpeg",
+            "X-Goog-Upload-Protocol": "raw",
+            "X-Goog-Upload-File-Name": os.path.basename(photo_file_name),
+        }
 
-        # interrupt upload if an upload was requested but could not be created
-        if album_name and not album_id:
-            return
+        body = photo_bytes
+        if body is None:
+            # a file is streamed from disk, a time-lapse clip never has to fit in memory at once
+            try:
+                body = open(photo_file_name, mode="rb")
+            except OSError as err:
+                logging.error(f"Could not read file {photo_file_name} -- {err}")
+                return None
 
-        self._session.headers["Content-type"] = "application/octet-stream"
-        self._session.headers["X-Goog-Upload-Protocol"] = "raw"
+        logging.info(f"Uploading photo -- {photo_file_name}")
 
         try:
-            photo_file = open(photo_file_name, mode="rb")
-            photo_bytes = photo_file.read()
-        except OSError as err:
-            logging.error("Could not read file {photo_file_name} -- {err}")
-            return
+            upload_token = self._session.post(
+                f"{self.api_url}/uploads", body, headers=headers, timeout=self.REQUEST_TIMEOUT
+            )
+        finally:
+            if photo_bytes is None:
+                body.close()
+
+        if (upload_token.status_code == 200) and upload_token.content:
+            return upload_token.content.decode()
 
-        self._session.headers["X-Goog-Upload-File-Name"] = os.path.basename(
-            photo_file_name
+        logging.error(
+            f"Could not upload {os.path.basename(photo_file_name)}. Server Response - {upload_token}"
         )
+        return None
 
-        logging.info(f"Uploading photo -- {photo_file_name}")
+    def _upload_frame(self, frame):
+        # a failed frame only loses its own token, the rest of the group still goes up and is added
+        try:
+            # frames that are still in memory go up in one request, there is no file to resume from
+            if frame.in_memory or not self.resumable:
+                return self._upload_bytes(frame.path, frame.data)
+            return self._upload_resumable(frame.path)
+        except (requests.RequestException, OSError) as err:
+            logging.error(f"Could not upload {frame.file_name} -- {err}")
+            return None
+
+    def _load_upload_session(self, session_file, size):
+        try:
+            with open(session_file) as f:
+                upload_session = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.exception(f"Could not load the upload session {session_file}, starting the upload over\n")
+            return None
+
+        # the photo was replaced since the session was started
+        if upload_session.get("size") != size:
+            return None
 
-        upload_token = self._session.post(
-            "https://photoslibrary.googleapis.com/v1/uploads", photo_bytes
+        # ask the server how much of the file it actually received before the transfer stopped
+        resp = self._session.post(
+            upload_session["url"], headers={"Content-Length": "0", "X-Goog-Upload-Command": "query"},
+            timeout=self.REQUEST_TIMEOUT,
         )
+        if resp.status_code != 200 or resp.headers.get("X-Goog-Upload-Status") != "active":
+            logging.info(f"Upload session in {session_file} has expired, starting the upload over")
+            return None
 
-        if (upload_token.status_code == 200) and upload_token.content:
-            create_body = json.dumps(
-                {
-                    "albumId": album_id,
-                    "newMediaItems": [
-                        {
-                            "description": "",
-                            "simpleMediaItem": {
-                                "uploadToken": upload_token.content.decode()
-                            },
-                        }
-                    ],
-                },
-                indent=4,
+        upload_session["offset"] = int(resp.headers.get("X-Goog-Upload-Size-Received", 0))
+        return upload_session
+
+    def _save_upload_session(self, session_file, upload_session):
+        write_atomic(session_file, json.dumps(upload_session))
+
+    def _start_upload_session(self, photo_file_name, size):
+        headers = {
+            "Content-Length": "0",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Content-Type": mimetypes.guess_type(photo_file_name)[0] or "image/jpeg",
+            "X-Goog-Upload-File-Name": os.path.basename(photo_file_name),
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Raw-Size": str(size),
+        }
+        resp = self._session.post(f"{self.api_url}/uploads", headers=headers, timeout=self.REQUEST_TIMEOUT)
+
+        if resp.status_code != 200 or "X-Goog-Upload-URL" not in resp.headers:
+            logging.error(
+                f"Could not start a resumable upload for {os.path.basename(photo_file_name)}. Server Response - {resp}"
             )
+            return None
 
-            resp = self._session.post(
-                "https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate",
-                create_body,
-            ).json()
+        granularity = int(resp.headers.get("X-Goog-Upload-Chunk-Granularity", 1))
+        return {
+            "url": resp.headers["X-Goog-Upload-URL"],
+            "offset": 0,
+            "size": size,
+            "chunk_size": -(-self.chunk_size // granularity) * granularity,
+        }
 
-            logging.debug(f"Server response: {resp}")
+    def _upload_resumable(self, photo_file_name):
+        # the session url and confirmed offset are kept next to the photo so an interrupted
+        # transfer carries on where it stopped, even after a restart
+        session_file = photo_file_name + ".upload"
 
-            if "newMediaItemResults" in resp:
-                status = resp["newMediaItemResults"][0]["status"]
-                if status.get("code") and (status.get("code") > 0):
-                    logging.error(
-                        f"Could not add {os.path.basename(photo_file_name)} to library -- {status['message']}"
-                    )
-                else:
-                    logging.info(
-                        f"Added {os.path.basename(photo_file_name)} to library and album {album_name}"
+        try:
+            size = os.path.getsize(photo_file_name)
+            upload_session = self._load_upload_session(session_file, size)
+            if upload_session is None:
+                upload_session = self._start_upload_session(photo_file_name, size)
+                if upload_session is None:
+                    return None
+                self._save_upload_session(session_file, upload_session)
+
+            logging.info(f"Uploading photo -- {photo_file_name} from byte {upload_session['offset']}")
+
+            with open(photo_file_name, mode="rb", buffering=upload_session["chunk_size"]) as photo_file:
+                photo_file.seek(upload_session["offset"])
+                while True:
+                    chunk = photo_file.read(upload_session["chunk_size"])
+                    last_chunk = upload_session["offset"] + len(chunk) >= size
+                    headers = {
+                        "Content-Length": str(len(chunk)),
+                        "X-Goog-Upload-Command": "upload, finalize" if last_chunk else "upload",
+                        "X-Goog-Upload-Offset": str(upload_session["offset"]),
+                    }
+                    resp = self._session.post(
+                        upload_session["url"], chunk, headers=headers, timeout=self.REQUEST_TIMEOUT
                     )
-            else:
+
+                    if resp.status_code != 200:
+                        logging.error(
+                            f"Resumable upload of {os.path.basename(photo_file_name)} stopped at byte "
+                            f"{upload_session['offset']}. Server Response - {resp}"
+                        )
+                        return None
+
+                    if last_chunk:
+                        break
+
+                    upload_session["offset"] += len(chunk)
+                    self._save_upload_session(session_file, upload_session)
+
+        except OSError as err:
+            # includes connection errors from requests, the session file keeps the last confirmed offset
+            logging.error(f"Resumable upload of {photo_file_name} was interrupted -- {err}")
+            return None
+
+        try:
+            os.remove(session_file)
+        except OSError:
+            pass
+
+        if not resp.content:
+            logging.error(f"No upload token returned for {os.path.basename(photo_file_name)}")
+            return None
+        return resp.content.decode()
+
+    def _post_batch_create(self, album_id, uploaded):
+        create_body = json.dumps(
+            {
+                "albumId": album_id,
+                "newMediaItems": [
+                    {
+                        "description": "",
+                        "simpleMediaItem": {"uploadToken": upload_token},
+                    }
+                    for _, upload_token in uploaded
+                ],
+            },
+            indent=4,
+        )
+
+        resp = self._session.post(
+            f"{self.api_url}/mediaItems:batchCreate",
+            create_body,
+            timeout=self.REQUEST_TIMEOUT,
+        ).json()
+
+        logging.debug(f"Server response: {resp}")
+        return resp
+
+    def _batch_create(self, album_id, album_name, uploaded):
+        # uploaded is a list of (photo_file_name, upload_token), returns the names of the photos added to the
+        # library mapped to the id of their new media item
+        resp = self._post_batch_create(album_id, uploaded)
+
+        # the cached album id is stale (e.g. the album was deleted), look the album up again and retry once,
+        # the upload tokens are still valid for the second attempt
+        if album_name and resp.get("error", {}).get("code") in (400, 403, 404):
+            logging.warning(f"Album id for {album_name} was rejected, looking it up again")
+            self.forget_album(album_name)
+            album_id = self.create_or_retrieve_album(album_name)
+            if album_id:
+                resp = self._post_batch_create(album_id, uploaded)
+
+        if "newMediaItemResults" not in resp:
+            for photo_file_name, _ in uploaded:
                 logging.error(
                     f"Could not add {os.path.basename(photo_file_name)} to library. Server Response -- {resp}"
                 )
+            return {}
+
+        # results are matched back to the files by upload token, the order is not guaranteed
+        names_by_token = {upload_token: photo_file_name for photo_file_name, upload_token in uploaded}
+        added = {}
+        for result in resp["newMediaItemResults"]:
+            photo_file_name = names_by_token.get(result.get("uploadToken"))
+            if photo_file_name is None:
+                continue
+            status = result.get("status", {})
+            if status.get("code") and (status.get("code") > 0):
+                logging.error(
+                    f"Could not add {os.path.basename(photo_file_name)} to library -- {status.get('message')}"
+                )
+            else:
+                logging.info(
+                    f"Added {os.path.basename(photo_file_name)} to library and album {album_name}"
+                )
+                added[photo_file_name] = result.get("mediaItem", {}).get("id")
 
+        return added
+
+    def upload_photos(self, photo_file_name, album_name):
+        return photo_file_name in self.upload_photo_batch([photo_file_name], album_name)
+
+    def upload_photo_batch(self, photo_file_names, album_name, workers=None):
+        frames = [Frame.from_file(album_name, photo_file_name) for photo_file_name in photo_file_names]
+        return {frame.path for frame in self.upload_frames(frames, album_name, workers)}
+
+    def upload_frames(self, frames, album_name, workers=None):
+        with metrics.timer("upload_seconds", album=album_name):
+            added = self._upload_frames(frames, album_name, workers)
+        metrics.count("photos_uploaded_total", len(added), album=album_name)
+        metrics.count("photos_failed_total", len(frames) - len(added), album=album_name)
+        return added
+
+    def _upload_frames(self, frames, album_name, workers=None):
+        album_id = self.create_or_retrieve_album(album_name) if album_name else None
+
+        # interrupt upload if an upload was requested but could not be created
+        if album_name and not album_id:
+            return []
+
+        workers = workers or self.upload_workers
+
+        # push the raw bytes of several photos at the same time, each one gets its own upload token
+        if workers > 1 and len(frames) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                tokens = list(pool.map(self._upload_frame, frames))
         else:
-            logging.error(
-                f"Could not upload {os.path.basename(photo_file_name)}. Server Response - {upload_token}"
-            )
+            tokens = [self._upload_frame(frame) for frame in frames]
+
+        uploaded = [
+            (frame.path, upload_token)
+            for frame, upload_token in zip(frames, tokens)
+            if upload_token
+        ]
+
+        # the api accepts at most 50 new media items per batchCreate call
+        added = {}
+        for start in range(0, len(uploaded), self.BATCH_CREATE_LIMIT):
+            # served from the album cache, picks up a new id if an earlier batch found the old one stale
+            album_id = self._album_ids.get(album_name.lower(), album_id) if album_name else None
+            added.update(self._batch_create(
+                album_id, album_name, uploaded[start:start + self.BATCH_CREATE_LIMIT]
+            ))
+
+        for frame in frames:
+            frame.remote_id = added.get(frame.path)
+        return [frame for frame in frames if frame.path in added]
+
+    def upload_and_remove_photos(self, photo_file_names, album_name, workers=None):
+        frames = [Frame.from_file(album_name, photo_file_name) for photo_file_name in photo_file_names]
+        return self.upload_and_remove_frames(frames, album_name, workers)
 
+    def upload_and_remove_frames(self, frames, album_name, workers=None):
         try:
-            del self._session.headers["Content-type"]
-            del self._session.headers["X-Goog-Upload-Protocol"]
-            del self._session.headers["X-Goog-Upload-File-Name"]
-        except KeyError:
-            pass
+            added = self.upload_frames(frames, album_name, workers)
+        except BaseException as e:
+            logging.exception(
+                f"Failed to upload {', '.join(frame.file_name for frame in frames)} to Google Photos"
+            )
+            return []
 
-    def upload_all_photos_in_dir(self, directory, album_name):
-        for entry in os.scandir(directory):
-            if entry.path.endswith(".jpg"):
-                try:
-                    self.upload_photos(entry.path, album_name)
-                    os.remove(entry.path)
-                except BaseException as e:
-                    logging.exception(
-                        f"Failed to upload {entry.path} to Google Photos"
-                    )
+        # only delete the photos that made it into the library, the rest get retried later
+        for frame in added:
+            frame.discard()
 
+        return added
+
+    def upload_all_photos_in_dir(self, directory, album_name, workers=None):
+        photo_file_names = sorted(
+            entry.path for entry in os.scandir(directory) if entry.path.endswith(".jpg")
+        )
+        if photo_file_names:
+            self.upload_and_remove_photos(photo_file_names, album_name, workers)
@@ -7,7 +7,9 @@ import time
 import copy
 import string
 from AtlasI2C import (
-	 AtlasI2C
+	 AtlasI2C,
+	 discover_devices,
+	 query_devices
 )
 
 def print_devices(device_list, device):
@@ -19,17 +21,7 @@ def print_devices(device_list, device):
     #print("")
     
 def get_devices():
-    device = AtlasI2C()
-    device_address_list = device.list_i2c_devices()
-    device_list = []
-    
-    for i in device_address_list:
-        device.set_i2c_address(i)
-        response = device.query("I")
-        moduletype = response.split(",")[1] 
-        response = device.query("name,?").split(",")[1]
-        device_list.append(AtlasI2C(address = i, moduletype = moduletype, name = response))
-    return device_list 
+    return discover_devices()
        
 def print_help_text():
     print('''
@@ -93,11 +85,10 @@ def main():
             try:
                 while True:
                     print("-------press ctrl-c to stop the polling")
-                    for dev in device_list:
-                        dev.write("R")
-                    time.sleep(delaytime)
-                    for dev in device_list:
-                        print(dev.read())
+                    poll_start = time.time()
+                    for reading in query_devices(device_list, "R"):
+                        print(reading)
+                    time.sleep(max(0, delaytime - (time.time() - poll_start)))
                 
             except KeyboardInterrupt:       # catches the ctrl-c command, which breaks the loop above
                 print("Continuous polling stopped")
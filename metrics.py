@@ -0,0 +1,194 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from atomic_file import write_atomic
+
+
+# everything below is a no-op until enable() is called, a disabled timer is one flag check and a shared object
+_enabled = False
+_lock = threading.Lock()
+# (name, sorted label items) -> _Series
+_series = {}
+# recent observations kept per series for the rolling summary
+ROLLING_WINDOW = 512
+# prefix of every metric in the prometheus textfile
+NAMESPACE = "timed_reads"
+
+
+class _Series:
+    __slots__ = ("kind", "count", "total", "maximum", "recent")
+
+    def __init__(self, kind):
+        # "timer" or "counter", counters only use total
+        self.kind = kind
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.recent = deque(maxlen=ROLLING_WINDOW) if kind == "timer" else None
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        observe(self.name, time.monotonic() - self.start, **self.labels)
+        if exc_type is not None:
+            count(self.name.replace("_seconds", "") + "_errors_total", **self.labels)
+        return False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _series.clear()
+
+
+def _get(kind, name, labels):
+    key = (name, tuple(sorted(labels.items())))
+    series = _series.get(key)
+    if series is None:
+        series = _series.setdefault(key, _Series(kind))
+    return series
+
+
+def timer(name, **labels):
+    '''
+    context manager that records how long its block took under name, an
+    exception in the block also counts towards name_errors_total
+    '''
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, labels)
+
+
+def observe(name, seconds, **labels):
+    if not _enabled:
+        return
+    with _lock:
+        series = _get("timer", name, labels)
+        series.count += 1
+        series.total += seconds
+        series.maximum = max(series.maximum, seconds)
+        series.recent.append(seconds)
+
+
+def count(name, value=1, **labels):
+    if not _enabled:
+        return
+    with _lock:
+        series = _get("counter", name, labels)
+        series.count += 1
+        series.total += value
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _label_text(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+
+def _snapshot():
+    with _lock:
+        return [
+            (name, labels, series.kind, series.count, series.total, series.maximum,
+             sorted(series.recent) if series.recent is not None else None)
+            for (name, labels), series in sorted(_series.items())
+        ]
+
+
+def render_textfile():
+    '''
+    everything recorded so far in the prometheus text format, timers become
+    summaries with quantiles over the rolling window
+    '''
+    lines = []
+    typed = set()
+    for name, labels, kind, series_count, total, maximum, recent in _snapshot():
+        metric = f"{NAMESPACE}_{name}"
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f"# TYPE {metric} {'summary' if kind == 'timer' else 'counter'}")
+        if kind == "counter":
+            lines.append(f"{metric}{_label_text(labels)} {total}")
+            continue
+        for q in (0.5, 0.9, 0.99):
+            lines.append(f"{metric}{_label_text(labels, quantile=q)} {_percentile(recent, q):.6f}")
+        lines.append(f"{metric}_sum{_label_text(labels)} {total:.6f}")
+        lines.append(f"{metric}_count{_label_text(labels)} {series_count}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    '''
+    count, p50, p90, p99 and max of the recent observations of every timer,
+    and the totals of every counter
+    '''
+    result = {}
+    for name, labels, kind, series_count, total, maximum, recent in _snapshot():
+        key = name + _label_text(labels)
+        if kind == "counter":
+            result[key] = total
+        else:
+            result[key] = {
+                "count": series_count,
+                "p50": _percentile(recent, 0.5),
+                "p90": _percentile(recent, 0.9),
+                "p99": _percentile(recent, 0.99),
+                "max": maximum,
+            }
+    return result
+
+
+def export(textfile=None, summary_file=None):
+    if not _enabled:
+        return
+    # the textfile collector may read at any moment, it must never see a half written file
+    try:
+        if textfile:
+            write_atomic(textfile, render_textfile())
+        if summary_file:
+            write_atomic(summary_file, json.dumps(summary(), indent=2))
+    except OSError as err:
+        logging.error(f"Could not export the metrics - {err}")
@@ -0,0 +1,115 @@
+import time
+
+import numpy as np
+
+
+class WindowAggregate:
+    __slots__ = ("window_start", "count", "minimum", "maximum", "mean", "last")
+
+    def __init__(self, window_start, count, minimum, maximum, mean, last):
+        self.window_start = window_start
+        self.count = count
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        self.last = last
+
+
+class SensorAggregator:
+    # summarises a sensor's samples over tumbling windows aligned to the epoch, raw samples are only kept
+    # around anomalies
+    def __init__(self, window=300, deadband=None, bounds=None, zscore=None, raw_context=5):
+        self.window = window
+        # a window whose mean moved less than this since the last stored window is dropped
+        self.deadband = deadband
+        # (low, high), samples outside are anomalies
+        self.bounds = bounds
+        # samples further than this many standard deviations from their window mean are anomalies
+        self.zscore = zscore
+        # samples kept on each side of an anomaly
+        self.raw_context = raw_context
+
+        # per sensor: samples of the window that was still open at the last flush, and the last stored mean
+        self._carry = {}
+        self._last_mean = {}
+
+    def process(self, sensor, timestamps, values, now=None, final=False):
+        '''
+        returns (windows, raw) for the closed windows, where raw is a (timestamps, values) pair of the
+        samples around anomalies. the open window is carried over to the next call unless final is set
+        '''
+        timestamps = np.frombuffer(timestamps, dtype=np.float64)
+        values = np.frombuffer(values, dtype=np.float64)
+
+        carry = self._carry.pop(sensor, None)
+        if carry is not None:
+            timestamps = np.concatenate((carry[0], timestamps))
+            values = np.concatenate((carry[1], values))
+
+        if len(timestamps) == 0:
+            return [], (timestamps, values)
+
+        windows = np.floor(timestamps / self.window).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, windows[1:] != windows[:-1]])
+        ends = np.r_[starts[1:], len(values)]
+
+        # the newest window may still be collecting samples, hold it back for the next flush
+        now = time.time() if now is None else now
+        if not final and (windows[-1] + 1) * self.window > now:
+            self._carry[sensor] = (timestamps[starts[-1]:], values[starts[-1]:])
+            timestamps, values = timestamps[:starts[-1]], values[:starts[-1]]
+            starts, ends = starts[:-1], ends[:-1]
+            if len(starts) == 0:
+                return [], (timestamps, values)
+
+        counts = ends - starts
+        means = np.add.reduceat(values, starts) / counts
+        minimums = np.minimum.reduceat(values, starts)
+        maximums = np.maximum.reduceat(values, starts)
+        lasts = values[ends - 1]
+
+        anomalies = np.zeros(len(values), dtype=bool)
+        if self.bounds is not None:
+            anomalies |= (values < self.bounds[0]) | (values > self.bounds[1])
+        if self.zscore is not None:
+            sample_means = np.repeat(means, counts)
+            stds = np.sqrt(np.add.reduceat((values - sample_means) ** 2, starts) / counts)
+            sample_stds = np.repeat(stds, counts)
+            anomalies |= (sample_stds > 0) & (np.abs(values - sample_means) > self.zscore * sample_stds)
+
+        # widen every anomaly by raw_context samples on both sides
+        keep_raw = anomalies
+        if anomalies.any() and self.raw_context:
+            kernel = np.ones(2 * self.raw_context + 1)
+            # "same" would come back as long as the kernel when there are fewer samples than that, the full
+            # convolution is cut back to the samples instead
+            keep_raw = np.convolve(anomalies, kernel)[self.raw_context:self.raw_context + len(values)] > 0
+        anomalous_windows = np.add.reduceat(anomalies, starts) > 0
+
+        result = []
+        last_mean = self._last_mean.get(sensor)
+        # the deadband compares against the last stored window, so it has to walk the windows in order,
+        # there are only a handful per flush
+        for i in range(len(starts)):
+            if (
+                self.deadband is not None
+                and last_mean is not None
+                and not anomalous_windows[i]
+                and abs(means[i] - last_mean) < self.deadband
+            ):
+                continue
+            last_mean = float(means[i])
+            result.append(
+                WindowAggregate(
+                    float(windows[starts[i]] * self.window),
+                    int(counts[i]),
+                    float(minimums[i]),
+                    float(maximums[i]),
+                    last_mean,
+                    float(lasts[i]),
+                )
+            )
+        if last_mean is not None:
+            self._last_mean[sensor] = last_mean
+
+        return result, (timestamps[keep_raw], values[keep_raw])
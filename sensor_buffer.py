@@ -0,0 +1,45 @@
+import time
+from array import array
+
+
+class SensorRingBuffer:
+    __slots__ = ("capacity", "dropped", "_timestamps", "_values", "_start", "_count")
+
+    def __init__(self, capacity=4096):
+        # two flat arrays of doubles instead of a python object per reading, 16 bytes a sample
+        self.capacity = capacity
+        self.dropped = 0
+        self._timestamps = array("d", bytes(8 * capacity))
+        self._values = array("d", bytes(8 * capacity))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value, timestamp=None):
+        end = (self._start + self._count) % self.capacity
+        self._timestamps[end] = timestamp if timestamp is not None else time.time()
+        self._values[end] = value
+
+        # when the buffer is full the oldest reading is overwritten
+        if self._count == self.capacity:
+            self._start = (self._start + 1) % self.capacity
+            self.dropped += 1
+        else:
+            self._count += 1
+
+    def drain(self):
+        # returns (timestamps, values) as arrays, oldest first, and empties the buffer
+        end = self._start + self._count
+        if end <= self.capacity:
+            timestamps = self._timestamps[self._start:end]
+            values = self._values[self._start:end]
+        else:
+            wrapped = end - self.capacity
+            timestamps = self._timestamps[self._start:] + self._timestamps[:wrapped]
+            values = self._values[self._start:] + self._values[:wrapped]
+
+        self._start = 0
+        self._count = 0
+        return timestamps, values
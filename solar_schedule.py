@@ -0,0 +1,173 @@
+import json
+import logging
+from datetime import date, datetime, timedelta
+
+import pytz
+from astral.sun import SunDirection, elevation, golden_hour, noon, sunrise, sunset
+
+from atomic_file import write_atomic
+
+
+class SolarDay:
+    __slots__ = ("date", "sunrise", "sunset", "noon", "golden_morning", "golden_evening")
+
+    def __init__(self, date, sunrise, sunset, noon, golden_morning, golden_evening):
+        self.date = date
+        # unix timestamps, sunrise and sunset are None when the sun stays down all day
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.noon = noon
+        # (start, end) timestamps, or None when there is no golden hour that day
+        self.golden_morning = golden_morning
+        self.golden_evening = golden_evening
+
+    def to_json(self):
+        return [self.date.isoformat(), self.sunrise, self.sunset, self.noon, self.golden_morning,
+                self.golden_evening]
+
+    @classmethod
+    def from_json(cls, data):
+        day, sunrise, sunset, noon, golden_morning, golden_evening = data
+        return cls(date.fromisoformat(day), sunrise, sunset, noon,
+                   tuple(golden_morning) if golden_morning else None,
+                   tuple(golden_evening) if golden_evening else None)
+
+
+def _compute_day(observer, tz, day):
+    midnight = tz.localize(datetime.combine(day, datetime.min.time()))
+    solar_noon = noon(observer, day, tzinfo=tz)
+    try:
+        rise = sunrise(observer, day, tzinfo=tz).timestamp()
+        setting = sunset(observer, day, tzinfo=tz).timestamp()
+    except ValueError:
+        # polar day or polar night, the sun is either up or down the whole day
+        if elevation(observer, solar_noon) > 0:
+            rise = midnight.timestamp()
+            setting = tz.localize(datetime.combine(day + timedelta(days=1), datetime.min.time())).timestamp()
+        else:
+            rise = setting = None
+
+    golden = []
+    for direction in (SunDirection.RISING, SunDirection.SETTING):
+        try:
+            start, end = golden_hour(observer, day, direction, tzinfo=tz)
+            golden.append((start.timestamp(), end.timestamp()))
+        except ValueError:
+            golden.append(None)
+
+    return SolarDay(day, rise, setting, solar_noon.timestamp(), *golden)
+
+
+class SolarSchedule:
+    '''
+    a year of sunrise, sunset, solar noon and golden hour times for one
+    location, computed once and cached on disk. captures are planned on
+    absolute deadlines: golden_interval apart during the golden hours,
+    midday_interval apart within midday_window of solar noon and interval
+    apart for the rest of the daylight
+    '''
+    DAYS = 366
+
+    def __init__(self, location, cache_file, interval=300, golden_interval=60, midday_interval=600,
+                 midday_window=7200):
+        self.location = location
+        self.cache_file = cache_file
+        self.tz = pytz.timezone(location.timezone)
+        self.interval = interval
+        self.golden_interval = golden_interval
+        self.midday_interval = midday_interval
+        self.midday_window = midday_window
+        self._days = {}
+
+    def _cache_key(self):
+        return [self.location.latitude, self.location.longitude, self.location.timezone]
+
+    def _load(self, today):
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            logging.exception(f"Could not load the solar schedule {self.cache_file}, computing it again\n")
+            return False
+
+        if data.get("location") != self._cache_key():
+            return False
+        days = {}
+        for entry in data.get("days", []):
+            day = SolarDay.from_json(entry)
+            days[day.date] = day
+        # a day is added on each side so the night after the last day still finds tomorrow's sunrise
+        if today not in days or today + timedelta(days=1) not in days:
+            return False
+        self._days = days
+        return True
+
+    def _compute(self, start):
+        observer = self.location.observer
+        self._days = {}
+        for offset in range(-1, self.DAYS + 1):
+            day = start + timedelta(days=offset)
+            self._days[day] = _compute_day(observer, self.tz, day)
+
+        try:
+            write_atomic(
+                self.cache_file,
+                json.dumps({"location": self._cache_key(), "days": [d.to_json() for d in self._days.values()]}),
+            )
+        except OSError as err:
+            logging.error(f"Could not save the solar schedule - {err}")
+
+    def day(self, timestamp):
+        local_date = datetime.fromtimestamp(timestamp, self.tz).date()
+        solar_day = self._days.get(local_date)
+        if solar_day is None or local_date + timedelta(days=1) not in self._days:
+            if not self._load(local_date):
+                self._compute(local_date)
+            solar_day = self._days[local_date]
+        return solar_day
+
+    def is_daylight(self, timestamp):
+        solar_day = self.day(timestamp)
+        return solar_day.sunrise is not None and solar_day.sunrise <= timestamp < solar_day.sunset
+
+    def interval_at(self, timestamp):
+        solar_day = self.day(timestamp)
+        for golden in (solar_day.golden_morning, solar_day.golden_evening):
+            if golden is not None and golden[0] <= timestamp < golden[1]:
+                return self.golden_interval
+        if abs(timestamp - solar_day.noon) < self.midday_window:
+            return self.midday_interval
+        return self.interval
+
+    def next_sunrise(self, timestamp):
+        solar_day = self.day(timestamp)
+        # polar nights are skipped a day at a time, the cache covers a year so this stays cheap
+        for _ in range(self.DAYS):
+            if solar_day.sunrise is not None and solar_day.sunrise > timestamp:
+                return solar_day.sunrise
+            next_date = solar_day.date + timedelta(days=1)
+            solar_day = self.day(self.tz.localize(datetime.combine(next_date, datetime.min.time())).timestamp())
+        raise ValueError(f"The sun does not rise within {self.DAYS} days at {self._cache_key()}")
+
+    def first_capture(self, now):
+        # right away in daylight, otherwise at the next sunrise
+        return now if self.is_daylight(now) else self.next_sunrise(now)
+
+    def next_capture(self, deadline, now=None):
+        '''
+        the deadline after the given one. deadlines missed because a cycle
+        overran are skipped instead of fired back to back, so captures stay
+        on the grid the schedule laid out
+        '''
+        now = deadline if now is None else now
+        while True:
+            if self.is_daylight(deadline):
+                deadline += self.interval_at(deadline)
+                if not self.is_daylight(deadline):
+                    deadline = self.next_sunrise(deadline)
+            else:
+                deadline = self.next_sunrise(deadline)
+            if deadline > now:
+                return deadline
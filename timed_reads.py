@@ -1,60 +1,288 @@
 import json
 import logging
+import logging.handlers
 import os
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 
-import pytz
 from astral import LocationInfo
-from astral.sun import sun
 
+import AtlasI2C
+import metrics
+from cycle_log import CycleLogHandler
 from db_log import DBLog
+from frame import Frame
 from gphoto import GPhoto
+from solar_schedule import SolarSchedule
+from timelapse import TimelapseEncoder
+from upload_pipeline import UploadPipeline
+from upload_spool import UploadSpool
 from webcam import Webcam
 
+# seconds between the start of two capture cycles, captures are denser during the golden hours around sunrise
+# and sunset and sparser within MIDDAY_WINDOW seconds of solar noon
+CAPTURE_INTERVAL = 300
+GOLDEN_HOUR_INTERVAL = 60
+MIDDAY_INTERVAL = 600
+MIDDAY_WINDOW = 2 * 60 * 60
 
-def time_until_daylight(dt_sunrise, dt_sunset, loc):
-    present = datetime.now(pytz.timezone(loc.timezone))
+# a year of sunrise, sunset and golden hour times for location.json, recomputed when the location changes
+SOLAR_SCHEDULE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "solar_schedule.json")
 
-    # currently between sunrise and sunset, it's already daylight
-    if dt_sunrise <= present <= dt_sunset:
-        return 0
+# capture the ribbon camera through the video port into memory instead of as a full resolution still on the sd card
+RIBBON_WARM_CAPTURE = False
+RIBBON_WARM_RESOLUTION = (1920, 1080)
 
-    # if there hasn't been a sunrise for the day yet, wait for it
-    elif present < dt_sunrise:
-        return (dt_sunrise - present).total_seconds()
+# append frames to a daily time-lapse video per camera that is uploaded once at sunset, instead of
+# uploading every photo on its own
+TIMELAPSE = False
+TIMELAPSE_FPS = 24
+TIMELAPSE_RESOLUTION = (1920, 1080)
+TIMELAPSE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cam-photos/timelapse/")
 
-    # if the day is past sunset, wait for tomorrow's sunrise
-    elif present > dt_sunset:
-        tommorrow = datetime.today() + timedelta(days=1)
-        tmrw_times = sun(loc.observer, tommorrow, tzinfo=loc.timezone)
-        return (tmrw_times["sunrise"] - present).total_seconds()
+# frames that barely changed since the last uploaded one are not uploaded, every FRAME_FILTER_KEEP_EVERYth frame
+# and one every FRAME_FILTER_MAX_GAP seconds still are. skipped frames are deleted and logged to FRAME_FILTER_LOG,
+# point FRAME_FILTER_DEMOTE_DIR at a directory to keep them while tuning the threshold, nothing prunes it
+FRAME_FILTER = False
+# "mad" thresholds are in grey levels (0-255) of a 64x48 thumbnail, "dhash" ones are the share of differing hash bits
+FRAME_FILTER_METRIC = "mad"
+FRAME_FILTER_THRESHOLD = 3.0
+FRAME_FILTER_KEEP_EVERY = 12
+FRAME_FILTER_MAX_GAP = 60 * 60
+FRAME_FILTER_DEMOTE_DIR = None
+FRAME_FILTER_LOG = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cam-photos/frame_filter.jsonl")
 
-    raise Exception("No possible criteria for time until daylight was met.")
+# frames are shrunk to fit TRANSCODE_MAX_SIZE and re-encoded in a process pool before they are uploaded,
+# TRANSCODE_WORKERS None uses one worker per core
+TRANSCODE = False
+TRANSCODE_MAX_SIZE = (1920, 1080)
+TRANSCODE_QUALITY = 85
+TRANSCODE_PROGRESSIVE = True
+TRANSCODE_WORKERS = None
+
+# every Atlas board on the i2c bus is read once per cycle and its readings go to SensorReadings. with
+# SENSOR_AGGREGATE_WINDOW set, only summaries over windows of that many seconds (SensorAggregates) and the
+# readings around anomalies are stored
+SENSORS = False
+SENSOR_AGGREGATE_WINDOW = None
+
+# durable record of the frames waiting to be uploaded again
+UPLOAD_SPOOL_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cam-photos/upload_spool.sqlite")
+# finished upload jobs are kept this many seconds after their capture, then pruned when the day starts
+UPLOAD_SPOOL_KEEP_DONE = 7 * 24 * 60 * 60
+
+# app.log is rotated once it reaches this size instead of being read and truncated every cycle
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+# number of photos pushed to google photos at the same time when working through a backlog
+UPLOAD_WORKERS = 4
+# photos on disk are sent in chunks that carry on where they stopped after a dropped connection, instead of
+# in one request. frames still in memory always go up in one request
+RESUMABLE_UPLOADS = False
+
+# stage timings and counters, written after every cycle as a prometheus textfile for node_exporter's textfile
+# collector and as a rolling summary next to the script
+METRICS = False
+METRICS_TEXTFILE = "/var/lib/node_exporter/textfile_collector/timed_reads.prom"
+METRICS_SUMMARY_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "metrics_summary.json")
 
 
 class Resources:
     
-    def __init__(self):
-        self.gphotos = GPhoto()
-        self.sql_store = DBLog()
-        self.sql_store.connect_to_db()
-        self.wb = Webcam('')
+    def __init__(self, gphotos=None, sql_store=None, webcam=None, spool_file=UPLOAD_SPOOL_FILE):
+        # everything can be passed in already set up, e.g. pointed at local stand-ins by bench_cycle.py
+        self.gphotos = gphotos or GPhoto(upload_workers=UPLOAD_WORKERS, resumable=RESUMABLE_UPLOADS)
+        if sql_store is None:
+            sensor_aggregator = None
+            if SENSOR_AGGREGATE_WINDOW:
+                # numpy is only needed when the readings are aggregated
+                from sensor_aggregate import SensorAggregator
+
+                sensor_aggregator = SensorAggregator(SENSOR_AGGREGATE_WINDOW)
+            sql_store = DBLog(sensor_aggregator=sensor_aggregator)
+            sql_store.connect_to_db()
+        self.sql_store = sql_store
+        if webcam is not None:
+            self.wb = webcam
+        elif RIBBON_WARM_CAPTURE:
+            self.wb = Webcam('', ribbon_resolution=RIBBON_WARM_RESOLUTION, ribbon_warm=True)
+        else:
+            self.wb = Webcam('')
+        self.spool = UploadSpool(spool_file)
+        self.spool.prune(time.time() - UPLOAD_SPOOL_KEEP_DONE)
+        self.uploader = UploadPipeline(self.gphotos, self.spool)
+
+        self.transcoder = None
+        if TRANSCODE:
+            # pillow is only needed with transcoding on
+            from transcode import Transcoder
+
+            self.transcoder = Transcoder(
+                self.uploader.submit,
+                max_size=TRANSCODE_MAX_SIZE,
+                quality=TRANSCODE_QUALITY,
+                progressive=TRANSCODE_PROGRESSIVE,
+                workers=TRANSCODE_WORKERS,
+            )
+
+        self.frame_filter = None
+        if FRAME_FILTER:
+            # numpy and pillow are only needed with the filter on
+            from frame_filter import FrameFilter
+
+            if FRAME_FILTER_DEMOTE_DIR:
+                os.makedirs(FRAME_FILTER_DEMOTE_DIR, exist_ok=True)
+            self.frame_filter = FrameFilter(
+                threshold=FRAME_FILTER_THRESHOLD,
+                metric=FRAME_FILTER_METRIC,
+                keep_every=FRAME_FILTER_KEEP_EVERY,
+                max_gap=FRAME_FILTER_MAX_GAP,
+                demote_dir=FRAME_FILTER_DEMOTE_DIR,
+                log_file=FRAME_FILTER_LOG,
+            )
+
+        # the boards are found from the cached addresses, only a missing or stale cache scans the bus
+        self.sensors = []
+        if SENSORS:
+            try:
+                self.sensors = AtlasI2C.discover_devices()
+            except Exception:
+                # a missing or faulty bus must not end in a reboot, the cameras carry on without the sensors
+                logging.exception("Could not find the Atlas sensors, carrying on without them")
+
+        self.timelapses = {}
+        if TIMELAPSE:
+            self.timelapses = {
+                camera: TimelapseEncoder(camera, TIMELAPSE_DIR, fps=TIMELAPSE_FPS, resolution=TIMELAPSE_RESOLUTION)
+                for camera in ("ribbon", "usb")
+            }
+            # earlier days whose segments were never joined, the clips are spooled for upload right below. today
+            # is left alone, a restart only adds a part to it and the whole day is joined once at sunset
+            today = datetime.now().strftime("%Y-%m-%d")
+            for encoder in self.timelapses.values():
+                encoder.finish_all(before=today)
+            self.spool.enqueue_dir(TIMELAPSE_DIR, "timelapse", extension=".mp4")
+
+        # anything left on disk that the spool doesn't know about yet, e.g. from before it existed
+        self.spool.enqueue_dir(self.wb.base_dir_ribbon, "ribbon")
+        self.spool.enqueue_dir(self.wb.base_dir_usb, "usb")
+        self.uploader.retry_due()
+
+    def output(self, camera, frame):
+        # frames go into the day's time-lapse when one is running, uploading the photo is the fallback
+        encoder = self.timelapses.get(camera)
+        if encoder is not None and encoder.append(frame):
+            frame.discard()
+            return
+        # near duplicates of the last uploaded frame are skipped
+        if self.frame_filter is not None and not self.frame_filter.keep(frame):
+            return
+        # the transcoder hands the smaller jpg to the uploader once it is done
+        if self.transcoder is not None:
+            self.transcoder.submit(frame, camera)
+            return
+        self.uploader.submit(frame, camera)
+
+    def read_sensors(self):
+        # all boards are read at once, the readings are written in bulk by the database writer
+        for device, reading in zip(self.sensors, AtlasI2C.query_devices(self.sensors)):
+            sensor = device.name or f"{device.moduletype} {device.address}"
+            if not reading.ok:
+                logging.warning(f"Could not read the {sensor} sensor -- {reading}")
+                continue
+            # boards that report several values, e.g. conductivity, get one series per value
+            for i, value in enumerate(reading.values):
+                self.sql_store.record_sensor(sensor if i == 0 else f"{sensor} {i}", value, reading.timestamp)
         
     def release(self):
-        self.sql_store.conn.close()
-        self.wb._camera.close()
+        # the day's time-lapse videos are uploaded once, together with whatever is still queued
+        for encoder in self.timelapses.values():
+            for clip in encoder.finish_all():
+                self.uploader.submit(Frame.from_file("timelapse", clip), "timelapse")
+
+        # finish the transcodes and uploads that are still queued before the session is closed
+        if self.transcoder is not None:
+            self.transcoder.close()
+        self.uploader.close()
+        self.spool.close()
+        self.sql_store.close()
+        # every board holds a reference on the shared bus, it is only closed once the last one is released
+        for device in self.sensors:
+            device.close()
+        self.wb.close()
         self.gphotos._session.close()
         
 
+def run_cycle(resources, cycle_log, present_dt=None):
+    '''
+    one capture cycle, returns the seconds spent in each stage
+    '''
+    present_dt = present_dt or datetime.now()
+    stages = {}
+    stage_start = time.monotonic()
+
+    # capture photos from both webcams at the same time
+    resources.wb.time = present_dt.strftime("%Y-%m-%d %H_%M_%S")
+    captures = resources.wb.capture_all()
+    stages["capture"] = time.monotonic() - stage_start
+
+    # hand the jpgs to the time-lapse or the background uploader, it sends them to google photos and
+    # then deletes them off local storage without holding up the next capture
+    stage_start = time.monotonic()
+    for camera, result in captures.items():
+        logging.debug(f"{camera} camera captured at {result.captured_at}, stages: {result.stages}")
+        for name, seconds in result.stages.items():
+            stages[f"{camera}.{name}"] = seconds
+        if result.ok:
+            resources.output(camera, result.frame)
+    stages["output"] = time.monotonic() - stage_start
+
+    if resources.sensors:
+        stage_start = time.monotonic()
+        resources.read_sensors()
+        stages["sensors"] = time.monotonic() - stage_start
+
+    # retry anything that failed to upload during an earlier cycle and is past its backoff
+    stage_start = time.monotonic()
+    resources.uploader.retry_due()
+    stages["retry"] = time.monotonic() - stage_start
+
+    # log any errors encountered during execution of this cycle into the database, one row per record
+    stage_start = time.monotonic()
+    record_errors(resources.sql_store, cycle_log)
+    stages["log"] = time.monotonic() - stage_start
+
+    return stages
+
+
+def record_errors(sql_store, cycle_log):
+    for record in cycle_log.drain():
+        sql_store.insert_error(record.created.strftime("%Y-%m-%d %H:%M:%S"), str(record))
+
+
 def main():
 
+    resources = None
+    cycle_log = None
     try:
         # need time to get internet connection once pi starts up
         time.sleep(120)  # if you lower this value and there is a critical error in your code your pi could get stuck in an infinite reboot loop!
         dir_path = os.path.dirname(os.path.realpath(__file__))
         
-        logging.basicConfig(filename=os.path.join(dir_path, "app.log"))
+        # errors of each cycle are collected in memory for the database, the file keeps a rotated history
+        cycle_log = CycleLogHandler()
+        logging.basicConfig(
+            handlers=[
+                logging.handlers.RotatingFileHandler(
+                    os.path.join(dir_path, "app.log"), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+                ),
+                cycle_log,
+            ]
+        )
+
+        if METRICS:
+            metrics.enable()
 
         # get current location
         with open(os.path.join(dir_path, 'location.json')) as loc_file:
@@ -64,53 +292,60 @@ def main():
             loc.latitude = data["coordinates"]["latitude"]
             loc.longitude = data["coordinates"]["longitude"]
 
-        # get sunrise and sunset times
-        times = sun(loc.observer, date=datetime.now(), tzinfo=loc.timezone)
+        schedule = SolarSchedule(
+            loc,
+            SOLAR_SCHEDULE_FILE,
+            interval=CAPTURE_INTERVAL,
+            golden_interval=GOLDEN_HOUR_INTERVAL,
+            midday_interval=MIDDAY_INTERVAL,
+            midday_window=MIDDAY_WINDOW,
+        )
 
-        # determine time until next daylight, sleep until then
-        sleep_time = time_until_daylight(times["sunrise"], times["sunset"], loc)
-        if sleep_time != 0:
-            time.sleep(sleep_time)
-            
-        resources = Resources()        
+        # captures fire on absolute deadlines, how long a cycle takes doesn't push the next one back
+        deadline = schedule.first_capture(time.time())
 
         while True:
-            
-            present_dt = datetime.now()
-
-            # capture photos from both webcams
-            resources.wb.time = present_dt.strftime("%Y-%m-%d %H_%M_%S")
-            resources.wb.capture_usb_photo()
-            resources.wb.capture_ribbon_photo()
-
-            # send the jpgs to google photos and then delete them off local storage
-            resources.gphotos.upload_all_photos_in_dir(resources.wb.base_dir_ribbon, "ribbon")
-            resources.gphotos.upload_all_photos_in_dir(resources.wb.base_dir_usb, "usb")
-
-            # log any errors encountered during execution of this cycle into the database
-            if os.path.getsize("./app.log") > 0:
-                with open("./app.log", "r") as f:
-                    error_message = f.read()
-                    resources.sql_store.insert_error(
-                        present_dt.strftime("%Y-%m-%d %H:%M:%S"), error_message
-                    )
-
-            # clear out the log
-            with open("./app.log", "w") as f:
-                pass
-
-            # regular sleep interval is 5 minutes, otherwise sleep until next sunrise
-            sleep_time = time_until_daylight(times["sunrise"], times["sunset"], loc)
-            if sleep_time == 0:
-                time.sleep(300)
-            else:
-                resources.release()
-                time.sleep(sleep_time)
+            # sleeps through the night too, the next deadline is then the next sunrise
+            time.sleep(max(0, deadline - time.time()))
+            if resources is None:
                 resources = Resources()
-                times = sun(loc.observer, date=datetime.now(), tzinfo=loc.timezone)
+
+            cycle_start = time.monotonic()
+            for stage, seconds in run_cycle(resources, cycle_log).items():
+                metrics.observe("cycle_stage_seconds", seconds, stage=stage)
+            metrics.observe("cycle_seconds", time.monotonic() - cycle_start)
+
+            # a cycle that ran past the next deadline skips it instead of starting the one after late
+            following = schedule.next_capture(deadline)
+            deadline = schedule.next_capture(deadline, now=time.time())
+            if deadline != following:
+                logging.warning(f"Capture cycle overran, skipped to the deadline at {datetime.fromtimestamp(deadline)}")
+                metrics.count("cycle_overruns_total")
+            metrics.export(METRICS_TEXTFILE, METRICS_SUMMARY_FILE)
+
+            # after sunset everything is shut down until the first capture of the next day. deadlines never land
+            # in the dark, so a night before the next one means it is the next sunrise
+            if not schedule.is_daylight(deadline - 1):
+                resources.release()
+                resources = None
 
     except BaseException as e:
         logging.exception('Something went wrong in the __main__ script. Restarting the pi.\n')
+        try:
+            # photos that only exist in memory are written to disk so they get uploaded after the reboot
+            if resources is not None:
+                if resources.transcoder is not None:
+                    resources.transcoder.close()
+                resources.uploader.abandon()
+
+            # the error that caused the reboot goes to RecordedErrors too, close() waits for the writer to send
+            # it and is bounded by the connect, read and write timeouts. unwritten rows stay in the backlog
+            if cycle_log is not None:
+                sql_store = resources.sql_store if resources is not None else DBLog()
+                record_errors(sql_store, cycle_log)
+                sql_store.close()
+        except BaseException:
+            logging.exception('Could not shut down cleanly before restarting the pi.\n')
         os.system('sudo reboot')
 
 
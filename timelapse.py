@@ -0,0 +1,160 @@
+import glob
+import logging
+import os
+import subprocess
+from datetime import datetime
+
+
+class TimelapseEncoder:
+    def __init__(self, camera, output_dir, fps=24, resolution=(1920, 1080), crf=23,
+                 codec="libx264", ffmpeg="ffmpeg"):
+        self.camera = camera
+        self.output_dir = output_dir
+        self.fps = fps
+        self.resolution = resolution
+        self.crf = crf
+        self.codec = codec
+        self.ffmpeg = ffmpeg
+
+        self.day = None
+        self.frame_count = 0
+        self._process = None
+        self._segment = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def _segment_paths(self, day):
+        return sorted(glob.glob(os.path.join(self.output_dir, f"{self.camera} {day} part*.mkv")))
+
+    def _segment_days(self):
+        # every day that still has segments on disk, e.g. from a night the pi was off at sunset
+        prefix = f"{self.camera} "
+        days = set()
+        for segment in glob.glob(os.path.join(self.output_dir, f"{glob.escape(prefix)}* part*.mkv")):
+            days.add(os.path.basename(segment)[len(prefix):].rsplit(" part", 1)[0])
+        return sorted(days)
+
+    def _start_segment(self, day):
+        # every run of the process gets its own matroska segment, they stay readable if the pi
+        # restarts mid-day and are stitched together without re-encoding at sunset
+        self.day = day
+        self._segment = os.path.join(
+            self.output_dir, f"{self.camera} {day} part{len(self._segment_paths(day)):03d}.mkv"
+        )
+
+        width, height = self.resolution
+        command = [
+            self.ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "image2pipe", "-framerate", str(self.fps), "-c:v", "mjpeg", "-i", "-",
+            "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                   f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+            "-c:v", self.codec, "-preset", "veryfast", "-crf", str(self.crf), "-pix_fmt", "yuv420p",
+            "-f", "matroska", self._segment,
+        ]
+
+        try:
+            # frames are piped in one at a time, ffmpeg only ever holds a few of them in memory
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            logging.exception(f"Could not start ffmpeg for the {self.camera} time-lapse")
+            self._process = None
+            return False
+
+        return True
+
+    def append(self, frame):
+        day = (frame.captured_at or datetime.now()).strftime("%Y-%m-%d")
+
+        # a frame from a new day closes the old video, it gets joined by the next finish_all()
+        if self._process is not None and day != self.day:
+            self._close_segment()
+
+        if self._process is None and not self._start_segment(day):
+            return False
+
+        try:
+            self._process.stdin.write(frame.read())
+            self._process.stdin.flush()
+        except OSError:
+            logging.exception(f"Could not add {frame.file_name} to the {self.camera} time-lapse")
+            self._close_segment()
+            return False
+
+        self.frame_count += 1
+        return True
+
+    def _close_segment(self):
+        process, self._process = self._process, None
+        if process is None:
+            return
+
+        # communicate closes ffmpeg's stdin itself, closing it first makes its flush fail on the closed pipe
+        _, stderr = process.communicate()
+
+        if process.returncode != 0:
+            logging.error(
+                f"ffmpeg failed while encoding {self._segment}, error: {stderr.decode(errors='replace')}"
+            )
+
+    def finish(self, day=None):
+        # stitches the day's segments into one clip with a stream copy, returns its path. a segment of
+        # another day that is still being encoded keeps running
+        day = day or self.day
+        if day is None:
+            return None
+        if day == self.day:
+            self._close_segment()
+
+        segments = [s for s in self._segment_paths(day) if os.path.getsize(s) > 0]
+        if not segments:
+            return None
+
+        clip = os.path.join(self.output_dir, f"{self.camera} {day}.mp4")
+        segment_list = os.path.join(self.output_dir, f"{self.camera} {day}.txt")
+        with open(segment_list, "w") as f:
+            for segment in segments:
+                escaped = segment.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+
+        completed_process = subprocess.run(
+            [
+                self.ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+                "-f", "concat", "-safe", "0", "-i", segment_list,
+                "-c", "copy", "-movflags", "+faststart", clip,
+            ],
+            capture_output=True,
+        )
+        os.remove(segment_list)
+
+        if completed_process.returncode != 0:
+            logging.error(
+                f"Could not join the {self.camera} time-lapse for {day}, error: "
+                f"{completed_process.stderr.decode(errors='replace')}"
+            )
+            return None
+
+        for segment in segments:
+            os.remove(segment)
+
+        if day == self.day:
+            self.day = None
+            self.frame_count = 0
+        return clip
+
+    def finish_all(self, before=None):
+        '''
+        stitches the segments of every day left on disk, not just the one
+        being encoded, returns the paths of the clips that were joined.
+        with before set ("YYYY-MM-DD") only earlier days are joined and the
+        segment being encoded is left running
+        '''
+        if before is None:
+            self._close_segment()
+        clips = []
+        for day in self._segment_days():
+            if before is not None and day >= before:
+                continue
+            clip = self.finish(day)
+            if clip:
+                clips.append(clip)
+        return clips
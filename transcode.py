@@ -0,0 +1,99 @@
+import io
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import metrics
+
+
+def transcode_jpeg(data, max_size, quality=85, progressive=True):
+    '''
+    shrinks a jpg to fit max_size and encodes it again at quality, the exif
+    block and colour profile are carried over. returns (jpg bytes, seconds),
+    the original bytes come back if the new jpg would not be smaller.
+    runs in the worker processes, so it only takes and returns plain values
+    '''
+    start = time.monotonic()
+    image = Image.open(io.BytesIO(data))
+    exif = image.info.get("exif")
+    icc_profile = image.info.get("icc_profile")
+
+    # the decoder scales down by a power of two on its own, the final resize only does the rest
+    image.draft("RGB", max_size)
+    image = image.convert("RGB")
+    image.thumbnail(max_size, Image.LANCZOS)
+
+    extra = {}
+    if exif:
+        extra["exif"] = exif
+    if icc_profile:
+        extra["icc_profile"] = icc_profile
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=quality, progressive=progressive, optimize=True, **extra)
+
+    result = out.getvalue()
+    if len(result) >= len(data):
+        result = data
+    return result, time.monotonic() - start
+
+
+class Transcoder:
+    '''
+    resizes and re-encodes frames in a process pool, one worker per core by
+    default, so the capture loop only hands frames over. the transcoded jpg
+    replaces the frame's bytes in memory and the frame is passed on to
+    on_done, a frame that fails to transcode is passed on unchanged
+    '''
+    def __init__(self, on_done, max_size=(1920, 1080), quality=85, progressive=True, workers=None):
+        self.on_done = on_done
+        self.max_size = max_size
+        self.quality = quality
+        self.progressive = progressive
+        # the workers are started from a clean server process, forking the capture process would copy the
+        # locks held by its uploader and database threads
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers or os.cpu_count() or 1, mp_context=multiprocessing.get_context("forkserver")
+        )
+
+    def submit(self, frame, *args):
+        '''
+        on_done(frame, *args) is called from the pool's result thread once the frame is transcoded
+        '''
+        try:
+            data = frame.read()
+        except OSError:
+            logging.exception(f"Could not read {frame.path} to transcode it, uploading it as it is")
+            self.on_done(frame, *args)
+            return
+
+        future = self._pool.submit(transcode_jpeg, data, self.max_size, self.quality, self.progressive)
+        future.add_done_callback(lambda f: self._done(f, frame, len(data), args))
+
+    def _done(self, future, frame, original_size, args):
+        try:
+            try:
+                data, seconds = future.result()
+            except Exception as e:
+                logging.warning(f"Could not transcode {frame.file_name}, uploading it as it is -- {e}")
+            else:
+                metrics.observe("transcode_seconds", seconds, camera=frame.camera)
+                metrics.count("transcode_bytes_saved_total", original_size - len(data), camera=frame.camera)
+                on_disk = not frame.in_memory
+                frame.data = data
+                # the smaller jpg in memory is the frame from now on, it is written back if the upload fails
+                if on_disk:
+                    try:
+                        os.remove(frame.path)
+                    except OSError:
+                        logging.exception(f"Could not remove {frame.path} after transcoding it")
+            self.on_done(frame, *args)
+        except Exception:
+            logging.exception(f"Could not hand over the transcoded frame {frame.file_name}")
+
+    def close(self):
+        # waits for the frames still being transcoded, their on_done has run when this returns
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,187 @@
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from frame import Frame
+
+
+class UploadPipeline:
+    # pushed onto the queue to tell the worker thread to exit once everything before it is uploaded
+    _STOP = object()
+
+    def __init__(self, gphotos, spool=None, max_queued=50, put_timeout=10, drain_timeout=600):
+        self.gphotos = gphotos
+        # frames that could not be uploaded are recorded here and retried with a backoff
+        self.spool = spool
+        self.put_timeout = put_timeout
+        self.drain_timeout = drain_timeout
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._abandon = threading.Event()
+        # the batch the worker took off the queue and is uploading right now
+        self._in_flight = []
+        self._in_flight_lock = threading.Lock()
+
+        self._worker = threading.Thread(target=self._run, name="gphotos-uploader", daemon=True)
+        self._worker.start()
+
+    def submit(self, frame, album_name, block=True):
+        if frame is None:
+            return False
+
+        with self._pending_lock:
+            # already waiting in the queue or currently being uploaded
+            if frame.path in self._pending:
+                return True
+            self._pending.add(frame.path)
+
+        try:
+            self._queue.put((frame, album_name), block=block, timeout=self.put_timeout)
+        except queue.Full:
+            # the frame goes to disk and into the spool, which hands it back once there is room again
+            with self._pending_lock:
+                self._pending.discard(frame.path)
+            frame.spill()
+            self._spool(frame)
+            logging.warning(f"Upload queue is full, leaving {frame.path} on disk for a later cycle")
+            return False
+
+        return True
+
+    def retry_due(self):
+        # fill whatever room is left in the queue with spooled frames that are due for another attempt
+        free = self._queue.maxsize - self._queue.qsize()
+        if self.spool is None or free <= 0:
+            return
+
+        for job in self.spool.claim(free):
+            if not os.path.exists(job.path):
+                logging.warning(f"{job.path} is no longer on disk, dropping its upload job")
+                self.spool.forget(job.id)
+                continue
+            frame = Frame(job.camera, job.path, captured_at=datetime.fromtimestamp(job.captured_at), job_id=job.id)
+            self.submit(frame, job.camera, block=False)
+
+    def _spool(self, frame, failed=False):
+        if self.spool is None:
+            return
+        if frame.job_id is None:
+            captured_at = frame.captured_at.timestamp() if frame.captured_at else None
+            frame.job_id = self.spool.enqueue(frame.path, frame.camera, captured_at)
+        if failed:
+            self.spool.fail(frame.job_id)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def join(self, timeout=None):
+        # waits until the worker went through everything queued so far, returns False on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self):
+        # wait for everything already queued to be uploaded before the session gets closed
+        try:
+            self._queue.put(self._STOP, timeout=self.put_timeout)
+        except queue.Full:
+            # the worker is stuck on a batch and the queue is full, don't wait for it
+            self.abandon()
+            logging.error("Upload queue did not accept the stop request, the remaining photos were written to disk")
+            return
+        self._worker.join(self.drain_timeout)
+
+        if self._worker.is_alive():
+            self.abandon()
+            logging.error(
+                f"Upload queue did not drain within {self.drain_timeout} seconds, "
+                f"the remaining photos were written to disk"
+            )
+
+    def abandon(self):
+        # the process is going down, everything still queued in memory is written to disk instead, including
+        # the batch the worker may be stuck on. if that batch still makes it, the worker removes the files again
+        self._abandon.set()
+        with self._in_flight_lock:
+            in_flight = list(self._in_flight)
+        for frame, _ in in_flight:
+            frame.spill()
+            self._spool(frame)
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not self._STOP:
+                item[0].spill()
+                self._spool(item[0])
+            self._queue.task_done()
+
+    def _next_batch(self):
+        # block for the first item, then take whatever else is already waiting so a backlog
+        # goes out in a few batchCreate calls instead of one per photo
+        try:
+            batch = [self._queue.get_nowait()]
+        except queue.Empty:
+            # nothing new from the capture loop, work through the spooled backlog in the meantime instead of
+            # waiting for the next cycle to hand it over
+            if not self._abandon.is_set():
+                try:
+                    self.retry_due()
+                except Exception:
+                    logging.exception("Could not take the due uploads from the spool")
+            batch = [self._queue.get()]
+        while batch[-1] is not self._STOP and len(batch) < self.gphotos.BATCH_CREATE_LIMIT:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is self._STOP
+            items = batch[:-1] if stop else batch
+            with self._in_flight_lock:
+                self._in_flight = items
+
+            albums = {}
+            for frame, album_name in items:
+                albums.setdefault(album_name, []).append(frame)
+
+            try:
+                for album_name, frames in albums.items():
+                    try:
+                        added = []
+                        if not self._abandon.is_set():
+                            added = self.gphotos.upload_and_remove_frames(frames, album_name)
+                        # frames that didn't make it go to disk and into the spool to be retried later
+                        for frame in frames:
+                            if frame in added:
+                                if self.spool is not None and frame.job_id is not None:
+                                    self.spool.complete(frame.job_id, frame.remote_id)
+                            else:
+                                frame.spill()
+                                self._spool(frame, failed=not self._abandon.is_set())
+                    finally:
+                        with self._pending_lock:
+                            self._pending.difference_update(frame.path for frame in frames)
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight = []
+                for _ in batch:
+                    self._queue.task_done()
+
+            if stop:
+                return
@@ -0,0 +1,139 @@
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+UploadJob = namedtuple("UploadJob", ["id", "path", "camera", "captured_at", "attempts"])
+
+
+class UploadSpool:
+    # first retry after a minute, doubling up to six hours between attempts
+    BACKOFF_BASE = 60
+    BACKOFF_MAX = 6 * 60 * 60
+    # a claimed job is handed out again if it was neither completed nor failed within this time
+    CLAIM_LEASE = 60 * 60
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS upload_jobs (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                camera TEXT NOT NULL,
+                captured_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                remote_id TEXT
+            )"""
+        )
+        # only unfinished jobs are indexed, so claiming stays a short index range scan no matter
+        # how many finished jobs have piled up
+        self._conn.execute(
+            """CREATE INDEX IF NOT EXISTS upload_jobs_due
+               ON upload_jobs(next_attempt_at, captured_at) WHERE remote_id IS NULL"""
+        )
+
+    # a path that comes back after its job finished is a new file, e.g. the clip of a day joined again, its
+    # job starts over. an unfinished job keeps its attempts and backoff
+    _INSERT = """INSERT INTO upload_jobs(path, camera, captured_at, next_attempt_at) VALUES (?, ?, ?, ?)
+                 ON CONFLICT(path) DO UPDATE SET camera = excluded.camera, captured_at = excluded.captured_at,
+                     attempts = 0, next_attempt_at = excluded.next_attempt_at, remote_id = NULL
+                 WHERE remote_id IS NOT NULL"""
+
+    def enqueue(self, path, camera, captured_at=None):
+        # new jobs are due at their capture time, so fresh work comes out oldest first
+        captured_at = captured_at or time.time()
+        with self._lock:
+            self._conn.execute(self._INSERT, (path, camera, captured_at, captured_at))
+            return self._conn.execute("SELECT id FROM upload_jobs WHERE path = ?", (path,)).fetchone()[0]
+
+    def enqueue_dir(self, directory, camera, extension=".jpg"):
+        rows = [
+            (entry.path, camera, entry.stat().st_mtime, entry.stat().st_mtime)
+            for entry in os.scandir(directory)
+            if entry.path.endswith(extension)
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(self._INSERT, rows)
+            self._conn.execute("COMMIT")
+
+    def claim(self, limit):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                jobs = [
+                    UploadJob(*row)
+                    for row in self._conn.execute(
+                        """SELECT id, path, camera, captured_at, attempts FROM upload_jobs
+                           WHERE remote_id IS NULL AND next_attempt_at <= ?
+                           ORDER BY next_attempt_at, captured_at LIMIT ?""",
+                        (now, limit),
+                    )
+                ]
+                self._conn.executemany(
+                    "UPDATE upload_jobs SET next_attempt_at = ? WHERE id = ?",
+                    [(now + self.CLAIM_LEASE, job.id) for job in jobs],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return jobs
+
+    def complete(self, job_id, remote_id):
+        # completing a job twice is a no-op, the first remote id is kept
+        with self._lock:
+            self._conn.execute(
+                "UPDATE upload_jobs SET remote_id = ? WHERE id = ? AND remote_id IS NULL",
+                (remote_id or "", job_id),
+            )
+
+    def fail(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT attempts FROM upload_jobs WHERE id = ? AND remote_id IS NULL", (job_id,)
+            ).fetchone()
+            if row is None:
+                return
+
+            attempts = row[0] + 1
+            # exponential backoff with a little jitter so a backlog doesn't retry in lockstep
+            delay = min(self.BACKOFF_BASE * 2 ** (attempts - 1), self.BACKOFF_MAX)
+            delay *= random.uniform(0.9, 1.1)
+            self._conn.execute(
+                "UPDATE upload_jobs SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+                (attempts, time.time() + delay, job_id),
+            )
+
+        logging.info(f"Upload job {job_id} failed {attempts} times, retrying in {delay:.0f} seconds")
+
+    def forget(self, job_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM upload_jobs WHERE id = ?", (job_id,))
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM upload_jobs WHERE remote_id IS NULL"
+            ).fetchone()[0]
+
+    def prune(self, older_than):
+        # drops finished jobs captured before older_than (a unix timestamp)
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM upload_jobs WHERE remote_id IS NOT NULL AND captured_at < ?", (older_than,)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,169 @@
+import glob
+import logging
+import os
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+
+# every video4linux device exposes its name here, no need to fork v4l2-ctl to find the webcam
+SYSFS_VIDEO4LINUX = "/sys/class/video4linux"
+
+
+def _read_sysfs(dev_dir, attribute):
+    try:
+        with open(os.path.join(dev_dir, attribute)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def find_video_device(device_name):
+    dev_dirs = glob.glob(os.path.join(SYSFS_VIDEO4LINUX, "video*"))
+    for dev_dir in sorted(dev_dirs, key=lambda d: int(os.path.basename(d)[len("video"):])):
+        name = _read_sysfs(dev_dir, "name")
+        # uvc cameras register a second metadata node with the same name, the capture node has index 0
+        if name and name.startswith(device_name) and _read_sysfs(dev_dir, "index") in (None, "0"):
+            return os.path.join("/dev", os.path.basename(dev_dir))
+    return None
+
+
+def _segments(jpeg):
+    # (marker, start, end) of every header segment up to the start of scan, the image data is not walked
+    i = 2
+    while i + 4 <= len(jpeg) and jpeg[i] == 0xFF:
+        marker = jpeg[i + 1]
+        if marker == 0xDA:
+            yield marker, i, i
+            return
+        end = i + 2 + int.from_bytes(jpeg[i + 2:i + 4], "big")
+        yield marker, i, end
+        i = end
+
+
+_huffman_tables = None
+
+
+def standard_huffman_tables():
+    '''
+    the DHT segments with the default tables from the jpeg spec. libjpeg writes
+    exactly these when it isn't asked to optimise, so they are taken from a
+    tiny encoded image instead of being spelled out here
+    '''
+    global _huffman_tables
+    if _huffman_tables is None:
+        ok, jpeg = cv2.imencode(".jpg", np.zeros((8, 8, 3), dtype=np.uint8))
+        jpeg = jpeg.tobytes()
+        _huffman_tables = b"".join(jpeg[start:end] for marker, start, end in _segments(jpeg) if marker == 0xC4)
+    return _huffman_tables
+
+
+def complete_mjpeg(frame):
+    '''
+    uvc webcams leave the huffman tables out of their mjpeg frames and rely on
+    the decoder knowing the defaults, a jpg file has to carry them
+    '''
+    sos = None
+    for marker, start, _ in _segments(frame):
+        if marker == 0xC4:
+            return frame
+        if marker == 0xDA:
+            sos = start
+    if sos is None:
+        return None
+    return frame[:sos] + standard_huffman_tables() + frame[sos:]
+
+
+class USBCamera:
+    # device paths resolved through sysfs, shared by every instance so the lookup happens once per process
+    _devices = {}
+
+    def __init__(self, device_name="HD Webcam C525", resolution=(1920, 1080), flush_frames=4, warmup_frames=20,
+                 jpeg_quality=90):
+        self.device_name = device_name
+        self.resolution = resolution
+        self.flush_frames = flush_frames
+        # frames dropped right after opening while auto exposure and white balance settle, like fswebcam -S 20
+        self.warmup_frames = warmup_frames
+        self.jpeg_quality = jpeg_quality
+        self._capture = None
+
+        if cv2 is None:
+            logging.warning("OpenCV is not installed, the usb webcam will be captured with fswebcam")
+
+    @property
+    def device(self):
+        device = self._devices.get(self.device_name)
+        if device is None or not os.path.exists(device):
+            device = find_video_device(self.device_name)
+            self._devices[self.device_name] = device
+        return device
+
+    def open(self):
+        if self._capture is not None:
+            return True
+
+        device = self.device
+        if cv2 is None or device is None:
+            return False
+
+        capture = cv2.VideoCapture(int(device[len("/dev/video"):]), cv2.CAP_V4L2)
+        if not capture.isOpened():
+            logging.error(f"Could not open the usb webcam at {device}")
+            self._devices.pop(self.device_name, None)
+            return False
+
+        capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # hand back the mjpeg buffer the camera sent instead of decoding it, it is uploaded as it is
+        capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+        for _ in range(self.warmup_frames):
+            capture.grab()
+
+        self._capture = capture
+        return True
+
+    def capture_jpeg(self):
+        # the device stays open and streaming between cycles so the exposure only settles once after
+        # opening, each capture just throws away the few frames still sitting in the driver's buffers
+        if not self.open():
+            return None
+
+        for _ in range(self.flush_frames):
+            self._capture.grab()
+
+        ok, frame = self._capture.read()
+        if not ok:
+            # most likely unplugged, the device gets resolved again on the next capture
+            logging.error(f"Could not read a frame from the usb webcam at {self._devices.get(self.device_name)}")
+            self.close()
+            self._devices.pop(self.device_name, None)
+            return None
+
+        # a single row of bytes is the raw mjpeg frame, a backend that decoded it anyway gets it encoded again
+        if frame.ndim <= 2 and frame.shape[0] == 1:
+            jpeg = complete_mjpeg(frame.tobytes())
+            if jpeg is not None:
+                return jpeg
+            frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+            if frame is None:
+                logging.error("Could not decode the mjpeg frame from the usb webcam")
+                return None
+
+        ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ok:
+            logging.error("Could not encode the usb webcam frame as a jpg")
+            return None
+
+        return jpeg.tobytes()
+
+    def close(self):
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
@@ -1,30 +1,84 @@
+import io
 import logging
 import os
 import re
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime
 
-from picamera import PiCamera
+try:
+    from picamera import PiCamera
+except ImportError:
+    PiCamera = None
+
+import metrics
+from frame import Frame
+from usb_camera import USBCamera
+
+
+class CaptureResult:
+    def __init__(self, camera):
+        self.camera = camera
+        self.frame = None
+        self.captured_at = None
+        self.error = None
+        # seconds spent in each stage of the capture, in the order they ran
+        self.stages = {}
+
+    @property
+    def ok(self):
+        return self.error is None and self.frame is not None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.monotonic() - start
+            metrics.observe("capture_stage_seconds", self.stages[name], camera=self.camera, stage=name)
 
 
 class Webcam:
-    def __init__(self, time):
+    def __init__(self, time, ribbon_resolution=(3280, 2464), ribbon_warm=False, ribbon_quality=85, photo_dir=None,
+                 ribbon_camera=None, usb_camera=None, capture_timeout=60):
         self.usb_cam_file = None
         self.usb_cam_photo_path = None
         self.ribbon_cam_file = None
         self.ribbon_cam_photo_path = None
         
-        dir_path = os.path.dirname(os.path.realpath(__file__))
+        photo_dir = photo_dir or os.path.join(os.path.dirname(os.path.realpath(__file__)), "cam-photos")
     
-        self.base_dir_ribbon = os.path.join(dir_path, "cam-photos/ribbon/")
-        self.base_dir_usb = os.path.join(dir_path, "cam-photos/usb/")
+        self.base_dir_ribbon = os.path.join(photo_dir, "ribbon/")
+        self.base_dir_usb = os.path.join(photo_dir, "usb/")
 
         self.time = time
 
         self.ansi_escape = re.compile(r"\x1B\[[0-?]*[ -/]*[@-~]")
 
-        # initialize ribbon camera
-        self._camera = PiCamera()
-        self._camera.resolution = (3280, 2464)
+        # initialize ribbon camera, any object with PiCamera's capture/close can be passed in instead
+        if ribbon_camera is None:
+            if PiCamera is None:
+                raise RuntimeError("picamera is not installed, pass a ribbon_camera to use another camera")
+            ribbon_camera = PiCamera()
+        self._camera = ribbon_camera
+        self._camera.resolution = ribbon_resolution
+
+        # in warm mode the ribbon camera is captured through the video port, the sensor keeps running
+        # between frames and the jpg is encoded into memory instead of onto the sd card
+        self.ribbon_warm = ribbon_warm
+        self.ribbon_quality = ribbon_quality
+
+        # usb webcam is kept open and streaming between captures, fswebcam is only the fallback
+        self._usb_camera = usb_camera or USBCamera()
+
+        # one thread per camera so both are triggered at the same moment
+        self._capture_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="capture")
+        # seconds a capture may take before it is given up on, and the last capture started per camera
+        self.capture_timeout = capture_timeout
+        self._running = {}
 
     @property
     def time(self):
@@ -50,10 +104,79 @@ class Webcam:
         self.ribbon_cam_file = None
         self.ribbon_cam_photo_path = None
 
-    def capture_usb_photo(self):
-        webcam_devices_proc = subprocess.run(
-            ["v4l2-ctl", "--list-devices"], text=True, capture_output=True
-        )
+    def close(self):
+        # a capture thread stuck on its device would never let the shutdown return
+        stuck = any(not future.done() for future in self._running.values())
+        self._capture_pool.shutdown(wait=not stuck)
+        self._usb_camera.close()
+        self._camera.close()
+
+    def capture_all(self):
+        captures = {"usb": self.capture_usb_photo, "ribbon": self.capture_ribbon_photo}
+        results = {}
+        futures = {}
+        for camera, capture in captures.items():
+            # a camera whose last capture never came back is skipped, its thread is still blocked on the device
+            running = self._running.get(camera)
+            if running is not None and not running.done():
+                results[camera] = self._failed_capture(camera, "is still stuck on its last capture")
+                continue
+            futures[camera] = self._running[camera] = self._capture_pool.submit(self._run_capture, camera, capture)
+
+        # a hanging camera is given up on after capture_timeout, the other one's result is used either way
+        done, _ = wait(futures.values(), timeout=self.capture_timeout)
+        for camera, future in futures.items():
+            if future in done:
+                results[camera] = future.result()
+            else:
+                results[camera] = self._failed_capture(
+                    camera, f"did not return a photo within {self.capture_timeout} seconds"
+                )
+        return {camera: results[camera] for camera in captures}
+
+    def _failed_capture(self, camera, reason):
+        result = CaptureResult(camera)
+        result.error = TimeoutError(f"The {camera} camera {reason}")
+        logging.error(str(result.error))
+        metrics.count("capture_failures_total", camera=camera)
+        return result
+
+    def _run_capture(self, camera, capture):
+        # a failing camera only marks its own result, the other capture carries on
+        result = CaptureResult(camera)
+        start = time.monotonic()
+        try:
+            capture(result)
+        except BaseException as e:
+            logging.exception(f"Something went wrong while trying to capture the photo from the {camera} camera.")
+            result.error = e
+        metrics.observe("capture_seconds", time.monotonic() - start, camera=camera)
+        if not result.ok:
+            metrics.count("capture_failures_total", camera=camera)
+        return result
+
+    def capture_usb_photo(self, result=None):
+        result = result or CaptureResult("usb")
+
+        with result.stage("grab"):
+            jpeg = self._usb_camera.capture_jpeg()
+        result.captured_at = datetime.now()
+
+        # the jpg stays in memory, it is only written to usb_cam_photo_path if the upload fails
+        if jpeg is not None:
+            result.frame = Frame("usb", self.usb_cam_photo_path, jpeg, result.captured_at)
+            return result
+
+        self._capture_usb_photo_fswebcam(result)
+        if self.usb_cam_photo_path:
+            result.frame = Frame("usb", self.usb_cam_photo_path, captured_at=result.captured_at)
+        return result
+
+    def _capture_usb_photo_fswebcam(self, result):
+        with result.stage("list_devices"):
+            webcam_devices_proc = subprocess.run(
+                ["v4l2-ctl", "--list-devices"], text=True, capture_output=True
+            )
         if webcam_devices_proc.returncode == 0:
             matches = re.search(
                 r"HD Webcam C525 \(\S+\):\n\t(\/dev\/video\d{1,2})",
@@ -61,21 +184,24 @@ class Webcam:
             )
             if matches:
                 device = matches.group(1)
-                completed_process = subprocess.run(
-                    [
-                        "fswebcam",
-                        "-d",
-                        f"{device}",
-                        "-r",
-                        "1920x1080",
-                        "-S",
-                        "20",  # discard first 20 images, camera needs time to adjust to brightness
-                        "--no-banner",
-                        self.usb_cam_photo_path,
-                    ],
-                    text=True,
-                    capture_output=True,
-                )
+                with result.stage("fswebcam"):
+                    completed_process = subprocess.run(
+                        [
+                            "fswebcam",
+                            "-d",
+                            f"{device}",
+                            "-r",
+                            "1920x1080",
+                            "-S",
+                            "20",  # discard first 20 images, camera needs time to adjust to brightness
+                            "--no-banner",
+                            self.usb_cam_photo_path,
+                        ],
+                        text=True,
+                        capture_output=True,
+                        timeout=self.capture_timeout,
+                    )
+                result.captured_at = datetime.now()
                 if completed_process.returncode != 0:
                     usbcam_error = (
                         self.ansi_escape.sub("", completed_process.stderr) + "\n\n"
@@ -101,13 +227,40 @@ class Webcam:
             )
             self.clear_usb()
 
-    def capture_ribbon_photo(self):
+    def capture_ribbon_photo(self, result=None):
+        result = result or CaptureResult("ribbon")
+        if self.ribbon_warm:
+            return self._capture_ribbon_photo_warm(result)
+
         try:
-            self._camera.capture(self.ribbon_cam_photo_path)
+            with result.stage("capture"):
+                self._camera.capture(self.ribbon_cam_photo_path)
+            result.captured_at = datetime.now()
         except BaseException as e:
             logging.exception(
                 "Something went wrong while trying to capture the photo from the ribbon camera."
             )
+            result.error = e
         if not os.path.exists(self.ribbon_cam_photo_path):
             logging.error(f"Photo at {self.ribbon_cam_photo_path} was not found.\n\n")
             self.clear_ribbon()
+        if self.ribbon_cam_photo_path:
+            result.frame = Frame("ribbon", self.ribbon_cam_photo_path, captured_at=result.captured_at)
+        return result
+
+    def _capture_ribbon_photo_warm(self, result):
+        stream = io.BytesIO()
+        try:
+            with result.stage("capture"):
+                self._camera.capture(stream, format="jpeg", use_video_port=True, quality=self.ribbon_quality)
+            result.captured_at = datetime.now()
+        except BaseException as e:
+            logging.exception(
+                "Something went wrong while trying to capture the photo from the ribbon camera."
+            )
+            result.error = e
+            self.clear_ribbon()
+            return result
+
+        result.frame = Frame("ribbon", self.ribbon_cam_photo_path, stream.getvalue(), result.captured_at)
+        return result